@@ -17,6 +17,12 @@ define (print-list-items xs)
 assert (= 1 (car one-through-four))
 assert (= 2 (car (cdr one-through-four)))
 
+  ; The arguments after the dot come as a list like any other.
+
+define (rest first . others) others
+assert (null? (rest 1))
+assert (= 3 (car (cdr (rest 1 2 3))))
+
   ; List operations
 
 define (list-ref items n)
@@ -58,3 +64,19 @@ define (square-list items)
      (cons (square (car items)) (square-list (cdr items)))
      nil
 
+
+  ; Long lists
+
+define (count-up-to n)
+  define (iter n acc)
+    if (= n 0)
+       acc
+       iter (- n 1) (cons n acc)
+  iter n nil
+
+define long-list (count-up-to 100000)
+
+assert (pair? long-list)
+assert (null? (cdr (list 1)))
+assert (= 100000 (car (reverse long-list)))
+assert (= 1 (car (cdr (append (list 100000) long-list))))
@@ -0,0 +1,723 @@
+# Benchmarks for peme.
+#
+#   python bench.py parse
+#   python bench.py stream
+#   python bench.py memory
+#   python bench.py lists
+#   python bench.py engines
+#   python bench.py cache
+#   python bench.py startup
+#   python bench.py memo
+#   python bench.py fold
+#   python bench.py arith
+#   python bench.py vectors
+#   python bench.py depth
+#   python bench.py parallel
+#   python bench.py suite > results.json
+#
+# Each benchmark prints a small table to stdout, except 'suite', which
+# prints JSON to compare between commits.
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import peme
+
+# A chunk of code in the style of the SICP scripts: indentation sugar,
+# explicit parentheses spread over lines, and both kinds of comments.
+SOURCE_CHUNK = '''\
+;;; Chunk %(n)d
+define (sum-%(n)d term a next b)
+  if (> a b)
+     0
+     + (term a)
+       (sum-%(n)d term (next a) next b)
+
+#| A block comment
+   spanning a couple of lines. |#
+(define (fib-%(n)d n)
+  (cond ((= n 0) 0)
+        ((= n 1) 1)
+        (else (+ (fib-%(n)d (- n 1))
+                 (fib-%(n)d (- n 2))))))  ; trailing comment
+
+assert
+  = 3025
+    sum-%(n)d cube 1 inc 10.5
+define p (Point %(n)d -%(n)d)
+set! p.x .5
+
+'''
+
+def generate_source(size):
+  """Generate at least 'size' bytes of peme source."""
+  chunks = []
+  total = 0
+  while total < size:
+    chunk = SOURCE_CHUNK % {'n': len(chunks)}
+    chunks.append(chunk)
+    total += len(chunk)
+  return ''.join(chunks)
+
+def best_of(repeat, function):
+  return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def bench_parse(options):
+  """Parse time of generated sources of growing size.
+
+  Parsing is a single pass, so time per MB should stay flat.
+  """
+  print('%10s %10s %10s' % ('bytes', 'seconds', 's/MB'))
+  for megabytes in (1, 2, 4, 8):
+    source = generate_source(megabytes * 2 ** 20)
+    seconds = best_of(options.repeat, lambda: peme.parse(source))
+    print('%10d %10.3f %10.3f' %
+          (len(source), seconds, seconds / len(source) * 2 ** 20))
+
+def bench_stream(options):
+  """Time until the first form is ready, reading a generated file.
+
+  parse has to read and parse the whole file first; parse_iter hands
+  out the first form after reading just a few lines.
+  """
+  def first_form_parse(path):
+    with open(path) as f:
+      return peme.parse(f.read(), path)[0]
+
+  def first_form_parse_iter(path):
+    with open(path) as f:
+      return next(peme.parse_iter(f, path))
+
+  print('%10s %12s %12s' % ('bytes', 'parse', 'parse_iter'))
+  for megabytes in (1, 4):
+    fd, path = tempfile.mkstemp(suffix='.scm')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        f.write(generate_source(megabytes * 2 ** 20))
+      print('%10d %12.4f %12.4f' % (
+          os.path.getsize(path),
+          best_of(options.repeat, lambda: first_form_parse(path)),
+          best_of(options.repeat, lambda: first_form_parse_iter(path))))
+    finally:
+      os.remove(path)
+
+try:
+  import tracemalloc
+except ImportError: # Python 2
+  tracemalloc = None
+
+def sizeof(obj):
+  """Bytes used by 'obj' itself, plus its __dict__ if it has one."""
+  size = sys.getsizeof(obj)
+  # Reading __dict__ makes Python allocate one, so empty ones are left
+  # out.
+  if getattr(obj, '__dict__', None):
+    size += sys.getsizeof(obj.__dict__)
+  if getattr(obj, 'attributes', None) is not None:
+    size += sys.getsizeof(obj.attributes)
+  return size
+
+def ast_nodes(ast):
+  yield ast
+  if isinstance(ast, list):
+    for child in ast:
+      for node in ast_nodes(child):
+        yield node
+
+def parse_size(source, filename):
+  """Parse 'source', returning the forms and the bytes the nodes take.
+
+  With tracemalloc this is everything the parse allocated. Without it
+  (Python 2), it is estimated by adding up the size of each node.
+  """
+  if tracemalloc is None:
+    forms = peme.parse(source, filename)
+    return forms, sum(sizeof(node)
+                      for form in forms for node in ast_nodes(form))
+  tracemalloc.start()
+  try:
+    forms = peme.parse(source, filename)
+    size, _ = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return forms, size
+
+def bench_memory(options):
+  """Size of AST nodes and runtime values, and the cost of making them.
+
+  Nodes are measured on the AST of 1.2.scm, values are the kind the
+  1.2.scm workload creates: numbers from arithmetic, lists from list*
+  and a closure and scope per call.
+  """
+  with open('1.2.scm') as f:
+    source = f.read()
+
+  forms, size = parse_size(source, '1.2.scm')
+  nodes = sum(1 for form in forms for _ in ast_nodes(form))
+  print('%-10s %8s %12s' % ('1.2.scm', 'nodes', 'bytes/node'))
+  print('%-10s %8d %12.1f' % ('AST', nodes, float(size) / nodes))
+
+  peme.bootstrap()
+  lambda_ = peme.root[peme.Symbol('square')]
+  makers = [
+      ('Int', lambda: peme.toObject(12345)),
+      ('Float', lambda: peme.toObject(1.5)),
+      ('List', lambda: peme.toObject([1, 2])),
+      ('Lambda', lambda: peme.Lambda(lambda_.arglist, lambda_.body,
+                                     lambda_.parentscope)),
+      ('Scope', lambda: lambda_.bind((1,))),
+  ]
+  count = 100000
+  print('')
+  print('%-10s %8s %12s' % ('value', 'bytes', 'allocs/s'))
+  for name, make in makers:
+    seconds = best_of(options.repeat, lambda: [make() for _ in range(count)])
+    print('%-10s %8d %12.0f' % (name, sizeof(make()), count / seconds))
+
+  print('')
+  seconds = best_of(options.repeat, lambda: peme.root.run_stream(
+      peme.parse_iter(source.splitlines(True), '1.2.scm')))
+  print('1.2.scm runs in %.3f s' % seconds)
+
+# List heavy code on top of the 2.2.scm definitions: lists built by
+# 'list' out of varargs and 'apply', and by the 'list*' builtin.
+LISTS_SOURCE = '''
+define (repeat n thunk)
+  (thunk)
+  if (= n 1)
+     nil
+     repeat (- n 1) thunk
+
+define (rebuild n ys)
+  if (= n 0)
+     ys
+     rebuild (- n 1) (apply list* ys)
+
+repeat 200
+  lambda ()
+    assert
+      = 16
+        length (map square (list 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16))
+
+assert
+  = 465
+    apply +
+      rebuild 5000
+        (list* 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21 22 23 24
+               25 26 27 28 29 30)
+'''
+
+def bench_lists(options):
+  """Run time of list heavy code, with both engines."""
+  with open('2.2.scm') as f:
+    source = f.read() + LISTS_SOURCE
+  forms = peme.parse(source, '2.2.scm')
+  print('%-10s %10s' % ('engine', 'seconds'))
+  for engine in sorted(peme.ENGINES):
+    peme.root.context.engine = engine
+    print('%-10s %10.3f' % (engine, best_of(
+        options.repeat, lambda: peme.root.run_stream(forms))))
+
+# Recursive processes in the style of 1.2.scm.
+ENGINES_SOURCES = [
+    ('fib 20', '''
+define (fib n)
+  if (< n 2)
+     n
+     + (fib (- n 1)) (fib (- n 2))
+assert (= 6765 (fib 20))
+'''),
+    ('count-down', '''
+define (count-down n)
+  if (= n 0)
+     0
+     count-down (- n 1)
+assert (= 0 (count-down 20000))
+'''),
+    ('sum 150', '''
+define (sum-to n)
+  if (= n 0)
+     0
+     + n (sum-to (- n 1))
+define (repeat n thunk)
+  (thunk)
+  if (= n 1)
+     nil
+     repeat (- n 1) thunk
+repeat 60 (lambda () (assert (= 11325 (sum-to 150))))
+'''),
+]
+
+def bench_engines(options):
+  """Run time of recursive processes with each engine."""
+  print('%-12s' % 'program' +
+        ''.join('%10s' % engine for engine in peme.ENGINES))
+  for name, source in ENGINES_SOURCES:
+    forms = peme.parse(source, name)
+    times = []
+    for engine in peme.ENGINES:
+      peme.root.context.engine = engine
+      times.append(best_of(options.repeat,
+                           lambda: peme.root.run_stream(forms)))
+    print('%-12s' % name + ''.join('%10.3f' % time for time in times))
+
+def bench_cache(options):
+  """Time to get the forms of a file, parsing it or from its cache."""
+  directory = tempfile.mkdtemp()
+  try:
+    sources = [('1.2.scm', open('1.2.scm').read())]
+    sources += [('%dMB' % megabytes, generate_source(megabytes * 2 ** 20))
+                for megabytes in (1, 4)]
+    print('%-10s %10s %10s %10s' % ('file', 'bytes', 'parse', 'cached'))
+    for name, source in sources:
+      path = os.path.join(directory, name + '.scm')
+      with open(path, 'w') as f:
+        f.write(source)
+      list(peme.parse_path(path)) # Writes the cache.
+      print('%-10s %10d %10.4f %10.4f' % (
+          name, len(source),
+          best_of(options.repeat,
+                  lambda: list(peme.parse_path(path, cache=False))),
+          best_of(options.repeat, lambda: list(peme.parse_path(path)))))
+  finally:
+    shutil.rmtree(directory)
+
+STARTUP_COMMANDS = [
+    ('python', ['-c', 'pass']),
+    ('import', ['-c', 'import peme']),
+    ('first eval', ['-c', 'import peme; '
+                          'peme.root.run(peme.parse("(square 2)")[0])']),
+    ('sandbox.scm', ['peme.py', 'sandbox.scm']),
+]
+
+def bench_startup(options):
+  """Wall time of fresh interpreter processes, until the first result.
+
+  'python' is the time for Python itself to start, for reference.
+  """
+  directory = os.path.dirname(os.path.abspath(__file__))
+  print('%-12s %10s' % ('command', 'seconds'))
+  for name, args in STARTUP_COMMANDS:
+    command = [sys.executable] + args
+    subprocess.check_call(command, cwd=directory) # Warm up the caches.
+    print('%-12s %10.4f' % (name, best_of(
+        options.repeat, lambda: subprocess.check_call(command,
+                                                      cwd=directory))))
+
+# Tree recursive processes from 1.2.scm, defined with 'define' and with
+# 'define-memo'.
+MEMO_SOURCES = [
+    ('fib 20', 'fib', '''
+%s (fib n)
+  if (< n 2)
+     n
+     + (fib (- n 1)) (fib (- n 2))
+assert (= 6765 (fib 20))
+'''),
+    ('nCr 16 8', 'nCr', '''
+%s (nCr n r)
+  if (or (= n r) (= 0 r))
+     1
+     + (nCr (- n 1) r) (nCr (- n 1) (- r 1))
+assert (= 12870 (nCr 16 8))
+'''),
+]
+
+def bench_memo(options):
+  """Run time of tree recursion, plain and memoized, with each engine.
+
+  The memoized versions are defined again for every run, so they start
+  with an empty cache.
+  """
+  print('%-10s %-8s' % ('program', 'engine') +
+        '%10s %10s %10s' % ('define', 'memo', 'hits'))
+  for name, function, source in MEMO_SOURCES:
+    plain = peme.parse(source % 'define', name)
+    memo = peme.parse(source % 'define-memo', name)
+    for engine in peme.ENGINES:
+      peme.root.context.engine = engine
+      times = [best_of(options.repeat, lambda: peme.root.run_stream(forms))
+               for forms in (plain, memo)]
+      hits = peme.root[peme.Symbol(function)].hits
+      print('%-10s %-8s' % (name, engine) +
+            '%10.4f %10.4f %10d' % (times[0], times[1], hits))
+
+# A loop with constant expressions and a branch on a constant in it.
+FOLD_SOURCE = '''
+define (loop n total)
+  if (= n 0)
+     total
+     loop (- n 1)
+          + total (* 24 60 60) (remainder 17 5)
+            if (< 1 2) 1 0
+assert (= 1728060000 (loop 20000 0))
+'''
+
+def bench_fold(options):
+  """Run time of a loop, as it is and with its constants folded."""
+  forms = peme.parse(FOLD_SOURCE, 'fold')
+  folded = list(peme.fold_constants(forms))
+  print('%-10s %10s %10s' % ('engine', 'plain', 'folded'))
+  for engine in peme.ENGINES:
+    peme.root.context.engine = engine
+    print('%-10s %10.3f %10.3f' % (engine, best_of(
+        options.repeat, lambda: peme.root.run_stream(forms)), best_of(
+        options.repeat, lambda: peme.root.run_stream(folded))))
+
+# Calls to the arithmetic builtins, with the number of arguments and
+# kinds of numbers Scheme code usually gives them.
+ARITH_CALLS = [
+    ('+', (3, 4)),
+    ('+', (3, 4, 5)),
+    ('-', (3, 4)),
+    ('*', (3, 4)),
+    ('*', (3, 4, 5)),
+    ('/', (12, 4)),
+    ('/', (1.5, 0.5)),
+    ('=', (3, 3)),
+    ('<', (3, 4)),
+    ('remainder', (17, 5)),
+    ('gcd', (12, 18)),
+]
+
+# An integer loop, in the style of 2.1.scm's rational numbers.
+ARITH_SOURCE = '''
+define (loop n total)
+  if (= n 0)
+     total
+     loop (- n 1)
+          + total (/ (* n 6) (gcd n 6)) (remainder n 7)
+assert (= 700109998 (loop 20000 0))
+'''
+
+def bench_arith(options):
+  """Calls per second of the arithmetic builtins, and a loop using them."""
+  count = 100000
+  print('%-10s %-14s %12s' % ('builtin', 'args', 'calls/s'))
+  for name, args in ARITH_CALLS:
+    function = peme.root[peme.Symbol(name)]
+    args = tuple(map(peme.toObject, args))
+    seconds = best_of(options.repeat,
+                      lambda: [function(*args) for _ in range(count)])
+    print('%-10s %-14s %12.0f' % (name, ' '.join(map(repr, args)),
+                                  count / seconds))
+
+  print('')
+  forms = peme.parse(ARITH_SOURCE, 'arith')
+  print('%-10s %10s' % ('engine', 'loop'))
+  for engine in peme.ENGINES:
+    peme.root.context.engine = engine
+    print('%-10s %10.3f' % (engine, best_of(
+        options.repeat, lambda: peme.root.run_stream(forms))))
+
+# Sum of the cubes of 1 to 10000, the way 1.3.scm does it and with
+# vectors.
+VECTORS_SETUP = '''
+define (sum term a next b)
+  define (iter a result)
+    if (> a b)
+       result
+       iter (next a) (+ result (term a))
+  iter a 0
+define (inc n) (+ n 1)
+'''
+VECTORS_SOURCES = [
+    ('sum', '(sum cube 1 inc 10000)'),
+    ('vector bulk', '(vector-sum (vector-map cube (vector-range 1 10001)))'),
+    ('vector lambda', '(vector-sum (vector-map (lambda (x) (* x x x)) '
+                      '(vector-range 1 10001)))'),
+    ('vector reduce', '(vector-reduce + 0 (vector-map cube '
+                      '(vector-range 1 10001)))'),
+]
+
+def bench_vectors(options):
+  """Run time of a sum over a range, with interpreted loops and vectors."""
+  peme.root.run_stream(peme.parse(VECTORS_SETUP, 'vectors'))
+  print('%-14s' % 'program' +
+        ''.join('%10s' % engine for engine in peme.ENGINES))
+  for name, source in VECTORS_SOURCES:
+    ast, = peme.parse(source, name)
+    times = []
+    for engine in peme.ENGINES:
+      peme.root.context.engine = engine
+      assert peme.root.run(ast) == 2500500025000000
+      times.append(best_of(options.repeat, lambda: peme.root.run(ast)))
+    print('%-14s' % name + ''.join('%10.4f' % time for time in times))
+
+DEPTH_SOURCE = '''
+define (sum-to n)
+  if (= n 0)
+     0
+     + n (sum-to (- n 1))
+'''
+
+def bench_depth(options):
+  """Run time of non-tail recursion to growing depths, with each engine.
+
+  The closure and tree engines recurse in Python, so they get a higher
+  recursion limit here, which is only enough for the shallowest run.
+  The vm keeps its frames on the heap.
+  """
+  sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+  definition = peme.parse(DEPTH_SOURCE, 'depth')
+  print('%-10s' % 'depth' + ''.join('%16s' % engine
+                                    for engine in peme.ENGINES))
+  for depth in (10 ** 3, 10 ** 5, 10 ** 6):
+    ast, = peme.parse('(sum-to %d)' % depth, 'depth')
+    results = []
+    for engine in peme.ENGINES:
+      peme.root.context.engine = engine
+      peme.root.run_stream(definition) # Compiled for this engine.
+      try:
+        seconds = best_of(options.repeat, lambda: peme.root.run(ast))
+      except RuntimeError: # RecursionError on Python 3.
+        results.append('too deep')
+      else:
+        results.append('%.0f calls/s' % (depth / seconds))
+    print('%-10d' % depth + ''.join('%16s' % result for result in results))
+
+PARALLEL_SOURCE = '''
+define (fib n)
+  if (< n 2)
+     n
+     + (fib (- n 1)) (fib (- n 2))
+'''
+
+def bench_parallel(options):
+  """Run time of fib over a list with map and with parallel-map.
+
+  parallel-map starts a pool of as many workers as there are cores for
+  each call, so it only pays off once the work outweighs that.
+  """
+  import multiprocessing
+  peme.root.run_stream(peme.parse(PARALLEL_SOURCE, 'parallel'))
+  print('%d cores' % multiprocessing.cpu_count())
+  print('%-14s %10s %14s' % ('items', 'map', 'parallel-map'))
+  for n, count in ((15, 8), (20, 8), (20, 32)):
+    items = ' '.join([str(n)] * count)
+    times = []
+    for name in ('map', 'parallel-map'):
+      ast, = peme.parse('(%s fib (list* %s))' % (name, items), 'parallel')
+      times.append(best_of(options.repeat, lambda: peme.root.run(ast)))
+    print('%-14s %10.3f %14.3f' % ('%d x fib %d' % (count, n), times[0],
+                                   times[1]))
+
+try:
+  import resource
+except ImportError: # Windows
+  resource = None
+
+# Programs 'suite' runs besides the SICP scripts, in the part of the
+# language that both interpreters understand.
+STRESS_SOURCES = [
+    ('recursion', '''
+define (sum-to n)
+  if (= n 0)
+     0
+     + n (sum-to (- n 1))
+
+define (repeat n thunk)
+  (thunk)
+  if (= n 1)
+     nil
+     repeat (- n 1) thunk
+
+repeat 60
+  lambda ()
+    assert (= 45150 (sum-to 300))
+'''),
+    ('lists', '''
+define (build n items)
+  if (= n 0)
+     items
+     build (- n 1) (cons n items)
+
+define (repeat n thunk)
+  (thunk)
+  if (= n 1)
+     nil
+     repeat (- n 1) thunk
+
+repeat 60
+  lambda ()
+    assert
+      = 300
+        length (reverse (append (map square (build 200 nil))
+                                (build 100 nil)))
+'''),
+    ('closures', '''
+; cons, car and cdr out of nothing but lambdas, as in SICP 2.1.3.
+define (kons x y)
+  lambda (m) (m x y)
+
+define (kar z)
+  z (lambda (p q) p)
+
+define (kdr z)
+  z (lambda (p q) q)
+
+define (klist n)
+  if (= n 0) nil (kons n (klist (- n 1)))
+
+define (ksum z n)
+  if (= n 0)
+     0
+     + (kar z) (ksum (kdr z) (- n 1))
+
+define (repeat n thunk)
+  (thunk)
+  if (= n 1)
+     nil
+     repeat (- n 1) thunk
+
+repeat 60
+  lambda ()
+    assert (= 20100 (ksum (klist 200) 200))
+'''),
+]
+
+SUITE_SCRIPTS = ['1.1.scm', '1.2.scm', '1.3.scm', '2.1.scm', '2.2.scm']
+SUITE_INTERPRETERS = ['scheme'] + ['peme:' + engine
+                                   for engine in peme.ENGINES]
+
+def peak_rss():
+  """Most memory this process has had resident, in bytes."""
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+def measure(interpreter, path, instrument=False):
+  """Run the script at 'path' and print what it took as JSON.
+
+  'suite' calls this in a fresh process for every run. Plain runs are
+  timed. Instrumented runs count evaluations and, with tracemalloc,
+  the peak of what Python allocated, which slows them down too much to
+  time.
+  """
+  # Neither the tree engine nor scheme.py can run without the Python
+  # stack, and scheme.py has no tail calls.
+  sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+  if interpreter == 'scheme':
+    import scheme
+    scheme.bootstrap(scheme.scm)
+    forms = scheme.parse_path(path)
+    run = lambda: scheme.scm(forms)
+    count_evals = scheme.count_evals
+  else:
+    peme.root.context.engine = interpreter.split(':')[1]
+    peme.bootstrap()
+    forms = list(peme.parse_path(path))
+    run = lambda: peme.root.run_stream(forms)
+    count_evals = peme.count_evals
+
+  result = {}
+  if instrument:
+    counter = count_evals()
+    if tracemalloc is not None:
+      tracemalloc.start()
+    run()
+    result['evals'] = counter.count
+    if tracemalloc is not None:
+      result['allocated_peak'] = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+  else:
+    start = timeit.default_timer()
+    run()
+    result['seconds'] = timeit.default_timer() - start
+    result['peak_rss'] = peak_rss()
+  print(json.dumps(result))
+
+def measure_in_child(interpreter, path, instrument=False):
+  """'measure' in a new process. Has an 'error' if the script failed."""
+  directory = os.path.dirname(os.path.abspath(__file__))
+  command = [sys.executable, '-c', 'import bench; bench.measure(%r, %r, %r)'
+             % (interpreter, path, instrument)]
+  process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+  output = process.communicate()[0].decode('utf-8', 'replace')
+  lines = output.strip().splitlines() or ['']
+  if process.returncode != 0:
+    return {'error': lines[-1]}
+  return json.loads(lines[-1])
+
+def bench_suite(options):
+  """Each SICP script and stress program, with each interpreter.
+
+  Prints JSON with a run for each pair: the best wall time of
+  'repeat' processes, evaluations per second, the peak of what Python
+  allocated (only with tracemalloc, so Python 3) and peak RSS. Runs
+  that fail have an 'error' instead, like scheme.py on 2.2.scm, whose
+  dotted arglist it can't parse. The stdlib is loaded and the script
+  parsed before the clock starts.
+  """
+  directory = os.path.dirname(os.path.abspath(__file__))
+  temporary = tempfile.mkdtemp()
+  try:
+    programs = [(name, os.path.join(directory, name))
+                for name in SUITE_SCRIPTS]
+    for name, source in STRESS_SOURCES:
+      path = os.path.join(temporary, name + '.scm')
+      with open(path, 'w') as f:
+        f.write(source)
+      programs.append((name, path))
+
+    runs = []
+    for name, path in programs:
+      for interpreter in SUITE_INTERPRETERS:
+        run = {'program': name, 'interpreter': interpreter}
+        timed = [measure_in_child(interpreter, path)
+                 for _ in range(options.repeat)]
+        if any('error' in result for result in timed):
+          run.update(next(result for result in timed if 'error' in result))
+        else:
+          run.update(min(timed, key=lambda result: result['seconds']))
+          run.update(measure_in_child(interpreter, path, instrument=True))
+          if 'evals' in run:
+            run['evals_per_second'] = run['evals'] / run['seconds']
+        runs.append(run)
+  finally:
+    shutil.rmtree(temporary)
+
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                     cwd=directory).decode().strip()
+  except (EnvironmentError, subprocess.CalledProcessError):
+    commit = None
+  json.dump({'commit': commit, 'python': sys.version.split()[0],
+             'runs': runs}, sys.stdout, indent=2, sort_keys=True)
+  print('')
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'stream': bench_stream,
+    'memory': bench_memory,
+    'lists': bench_lists,
+    'engines': bench_engines,
+    'cache': bench_cache,
+    'startup': bench_startup,
+    'memo': bench_memo,
+    'fold': bench_fold,
+    'arith': bench_arith,
+    'vectors': bench_vectors,
+    'depth': bench_depth,
+    'parallel': bench_parallel,
+    'suite': bench_suite,
+}
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='report the best of this many runs')
+  options = parser.parse_args()
+  BENCHMARKS[options.benchmark](options)
+
+if __name__ == '__main__':
+  exit(main() or 0)
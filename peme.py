@@ -1,36 +1,65 @@
 # Python style scheme hybrid.
 # More or less rewrite of scheme.py
+import array
+import bisect
+import collections
 import fractions
+import functools
+import hashlib
+import marshal
 import math
+import mmap
+import operator
+import os
 import re
 import sys
 
-PATH_TO_STDLIB = './stdlib.scm'
-
-EMPTY_LINE_RE = re.compile(r'^\s+?$', re.MULTILINE|re.DOTALL)
-BLOCK_COMMENT_RE = re.compile(r'\s*#\|.*?\|#\s*$', re.MULTILINE|re.DOTALL)
-LINE_COMMENT_RE = re.compile(r'\s*;.*?$', re.MULTILINE|re.DOTALL)
-FLOAT_RE = re.compile(r'(?:\+|\-)?(?:\.\d+|\d+\.\d*)')
-INT_RE = re.compile(r'(?:\+|\-)?\d+')
-SYMBOL_RE = re.compile(r'[^\s\(\)\.]+|\.(?![^\s\(\)\.])')
-ATTRIBUTE_RE = re.compile(r'\.[^\s\(\)\.]+')
-SPACE_RE = re.compile(r'(?:(?!\n)\s)+')
+try:
+  long
+except NameError: # Python 3, where int has no size limit.
+  long = int
+
+# gcd of two ints. math.gcd is Python 3.5+, and fractions.gcd is gone
+# since 3.9. fractions.gcd can be negative, so use abs on the result.
+gcd = getattr(math, 'gcd', None) or fractions.gcd
+
+PATH_TO_STDLIB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'stdlib.scm')
+
+# One alternative for each kind of token, tried in this order. Newlines
+# are only tokens outside of parentheses; the token's text is the
+# indentation of the line after it.
+TOKEN_RE = re.compile(r'''
+    (?P<newline>    \n\ *                       )
+  | (?P<space>      [^\S\n]+                    )
+  | (?P<comment>    ;[^\n]* | \#\|[\s\S]*?\|\#  )
+  | (?P<open>       \(                          )
+  | (?P<close>      \)                          )
+  | (?P<float>      [+-]?(?:\.\d+|\d+\.\d*)     )
+  | (?P<int>        [+-]?\d+                    )
+  | (?P<symbol>     [^\s().]+ | \.(?![^\s().])  )
+  | (?P<attribute>  \.[^\s().]+                 )
+''', re.VERBOSE)
 UNKNOWN_RE = re.compile(r'\S+')
 INDENT_RE = re.compile(r' *')
 
 class Object(object):
 
-  def __new__(cls, *args, **kwargs):
-    self = super(Object, cls).__new__(cls, *args, **kwargs)
-    self.attributes = dict()
+  # Object itself adds nothing to the instance layout, so that it can be
+  # mixed into int and str. Subclasses that aren't int or str subclasses
+  # declare __slots__; the rest get a __dict__, which Python only
+  # allocates once something is stored in it.
+  __slots__ = ()
 
-    # These fields are set by the parser if this object is
-    # part of an AST.
-    self.start = None
-    self.end = None
-    self.parse_result = None
+  # These fields are set by the parser if this object is
+  # part of an AST.
+  start = None
+  end = None
+  parse_result = None
 
-    return self
+  # Attributes set with 'setattr'. Most values never get any, so the
+  # dict is only created on the first 'setattr'.
+  attributes = None
 
   @property
   def location_message(self):
@@ -44,15 +73,22 @@ class Object(object):
 
   def setattr(self, attribute, value):
     assert isinstance(attribute, Symbol), attribute
+    if self.attributes is None:
+      self.attributes = dict()
     self.attributes[attribute] = value
     return value
 
   def getattr(self, attribute):
     assert isinstance(attribute, Symbol), attribute
+    if self.attributes is None:
+      raise KeyError(attribute)
     return self.attributes[attribute]
 
 class UserObject(Object):
 
+  def __init__(self):
+    self.attributes = dict()
+
   # TODO: If I put these methods in 'Object', Python complains to me
   #       that super does not have '__add__' or '__eq__', even though
   #       the next class in the mro is e.g. 'int'.
@@ -70,6 +106,19 @@ class UserObject(Object):
 
 
 class List(Object, list):
+  __slots__ = ('attributes', 'start', 'end', 'parse_result', 'cache')
+
+  def __init__(self, *args):
+    super(List, self).__init__(*args)
+    self.attributes = self.start = self.end = self.parse_result = None
+    # Inline cache of Scope.eval for this list as a call. See 'Context'.
+    self.cache = None
+
+  def __reduce__(self):
+    # Pickle just the items. The location would bring the whole
+    # ParseResult along, and the cache functions that don't pickle.
+    return List, (list(self),)
+
   def __repr__(self):
     if len(self) == 2 and self[0] == '__string__' and isinstance(self[1], str):
       return repr(str(self[1]))
@@ -82,14 +131,41 @@ class Symbol(Object, str):
   def __repr__(self):
     return str(self)
 
-class Int(Object, int):
+  def __reduce__(self):
+    return Symbol, (str(self),) # Without the location, like List.
+
+class Number(Object):
+  """Base of the number types. Numbers in an ast evaluate to themselves."""
+  __slots__ = ()
+
+  def __reduce__(self):
+    # Just the value of the int, float, etc. it is, without the
+    # location, like List.
+    cls = type(self)
+    return cls, (cls.__bases__[1](self),)
+
+class Int(Number, int):
   pass
 
-class Float(Object, float):
+class Float(Number, float):
   pass
 
+class Long(Number, long):
+  """Python 2 int that is too big for Int. Python 3 only needs Int."""
+
+  def __repr__(self):
+    return str(self) # Without the L.
+
+class Rational(Number, fractions.Fraction):
+  """Exact fraction, like the result of (/ 1 3)."""
+
+  def __repr__(self):
+    return str(self)
+
 class Bool(Object, int):
-  pass
+  # Pickle as the 'true' or 'false' of the module, like 'nil'.
+  def __reduce__(self):
+    return 'true' if self else 'false'
 
 true = Bool(True)
 false = Bool(False)
@@ -98,70 +174,380 @@ class Nil(Object):
   def __repr__(self):
     return 'nil'
 
+  def __reduce__(self):
+    # Unpickles as the 'nil' of the module, so 'is nil' still works.
+    return 'nil'
+
   def __nonzero__(self):
     return self.__bool__()
 
   def __bool__(self):
     return False
 
+  def __iter__(self):
+    return iter(())
+
 nil = Nil()
 
+class Pair(Object):
+  """A cons cell. A chain of these ending in nil is a list."""
+
+  __slots__ = ('attributes', 'car', 'cdr')
+
+  def __init__(self, car, cdr):
+    self.attributes = None
+    self.car = car
+    self.cdr = cdr
+
+  def __iter__(self):
+    pair = self
+    while isinstance(pair, Pair):
+      yield pair.car
+      pair = pair.cdr
+    if pair is not nil:
+      raise TypeError('Not a list: %r' % self)
+
+  def __repr__(self):
+    # Iterative, so that long lists don't hit the recursion limit.
+    items = []
+    pair = self
+    while isinstance(pair, Pair):
+      items.append(repr(pair.car))
+      pair = pair.cdr
+    if pair is not nil:
+      items += ['.', repr(pair)]
+    return '(%s)' % ' '.join(items)
+
+  def __reduce__(self):
+    # Pickle lists flat, as pickling nested Pairs recurses on each one.
+    items = []
+    pair = self
+    while isinstance(pair, Pair):
+      items.append(pair.car)
+      pair = pair.cdr
+    return make_list, (items, pair)
+
+def make_list(items, tail=nil):
+  """Build a list of Pairs out of a Python sequence, ending in 'tail'."""
+  for item in reversed(items):
+    tail = Pair(item, tail)
+  return tail
+
+class Vector(Object):
+  """Numbers packed in an array.array, or a list if they don't fit one.
+
+  See 'make_vector'.
+  """
+
+  __slots__ = ('attributes', 'items')
+
+  def __init__(self, items):
+    self.attributes = None
+    self.items = items
+
+  def __len__(self):
+    return len(self.items)
+
+  def __iter__(self):
+    return iter(map(toNumber, self.items))
+
+  def __repr__(self):
+    return '#(%s)' % ' '.join(map(repr, self))
+
+def make_vector(values, typecode=None):
+  """Pack the numbers 'values' in a Vector.
+
+  Integers go in a 'l' array, anything else in a 'd' array, which
+  turns them into floats. 'typecode' picks one up front. Rationals, and
+  numbers too big for the array, go in a plain list instead, so they
+  stay exact.
+  """
+  values = list(values)
+  try:
+    if typecode is None:
+      try:
+        return Vector(array.array('l', values))
+      except TypeError:
+        if any(isinstance(value, fractions.Fraction) for value in values):
+          return Vector(values)
+        typecode = 'd'
+    return Vector(array.array(typecode, values))
+  except OverflowError:
+    return Vector(values)
+
 class Function(Object):
-  pass
+  __slots__ = ('attributes',)
 
 class Lambda(Function):
-  def __init__(self, arglist, body, parentscope, vararg=None):
+  __slots__ = ('arglist', 'body', 'parentscope', 'vararg', 'code',
+               'environment')
+
+  def __init__(self, arglist, body, parentscope, vararg=None, code=None,
+               environment=None):
+    self.attributes = None
     self.arglist = arglist
     self.body = body
     self.parentscope = parentscope
     self.vararg = vararg
+    self.code = code # body as analyzed by 'analyze', if it was compiled.
+    self.environment = environment # Environment 'code' was analyzed in.
 
-  def __call__(self, *args):
+  def bind(self, args):
+    """Create the scope that the body of this lambda runs in."""
     if not self.vararg and len(self.arglist) != len(args):
       raise TypeError('Lambda expected %d args but found %d' %
                       (len(self.arglist), len(args)))
 
+    if self.environment is not None:
+      values = list(args)
+      if self.vararg:
+        values[len(self.arglist):] = [make_list(args[len(self.arglist):])]
+      values += self.environment.padding
+      return Scope(self.parentscope, slots=self.environment.slots,
+                   values=values)
+
     scope = Scope(self.parentscope)
     for name, value in zip(self.arglist, args):
       scope.declare(name, value)
 
     if self.vararg:
-      scope.declare(self.vararg, args[len(self.arglist):])
+      scope.declare(self.vararg, make_list(args[len(self.arglist):]))
+
+    return scope
 
-    last = None
+  def __call__(self, *args):
+    scope = self.bind(args)
+
+    if self.code is not None:
+      result = self.code(scope)
+      while isinstance(result, TailCall):
+        callstack = scope.context.callstack
+        if callstack:
+          callstack[-1] = result.ast
+        function = result.function
+        scope = function.bind(result.args)
+        result = function.code(scope)
+      return result
+
+    last = nil
     for ast in self.body:
       last = scope.eval(ast)
 
     return last
 
 class BuiltinFunction(Function):
-  def __init__(self, function):
+  __slots__ = ('function', 'returns')
+
+  def __init__(self, function, returns=None):
+    self.attributes = None
     self.function = function
+    # Turns what 'function' returns into an Object, or None if
+    # 'function' already returns Objects.
+    self.returns = returns
 
   def __call__(self, *args):
-    return self.function(*args)
+    if self.returns is None:
+      return self.function(*args)
+    return self.returns(self.function(*args))
+
+class Memoized(Function):
+  """A function that remembers its results, made by 'memoize'.
+
+  Results are kept in a least recently used cache of at most 'maxsize'
+  entries (no limit if None), keyed on the arguments. Calls with
+  arguments that can't be hashed, like Lists, aren't cached. The cache
+  statistics are readable from Scheme as attributes, and setting
+  'maxsize' resizes the cache.
+  """
+
+  __slots__ = ('function', 'maxsize', 'cache', 'hits', 'misses')
+
+  def __init__(self, function, maxsize=None):
+    self.attributes = None
+    self.function = function
+    self.cache = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.resize(maxsize)
+
+  def __call__(self, *args):
+    key, value = self.lookup(args)
+    if value is unassigned:
+      value = self.store(key, self.function(*args))
+    return value
+
+  def lookup(self, args):
+    """Return the key for 'args', and the result cached for it.
+
+    The result is 'unassigned' if there is none, and the key is None if
+    the arguments can't be cached. Counts a hit or a miss.
+    """
+    # 1, 1.0 and true are equal, but aren't the same argument.
+    key = (tuple(args), tuple(map(type, args)))
+    cache = self.cache
+    try:
+      # Moved to the end to mark it as recently used. Python 2's
+      # OrderedDict has no move_to_end.
+      value = cache.pop(key, unassigned)
+    except TypeError:
+      key = None
+      value = unassigned
+    if value is unassigned:
+      self.misses += 1
+    else:
+      cache[key] = value
+      self.hits += 1
+    return key, value
+
+  def store(self, key, value):
+    """Cache 'value' as the result for 'key' from 'lookup'."""
+    if key is not None:
+      self.cache[key] = value
+      self.trim()
+    return value
+
+  def resize(self, maxsize):
+    """Set 'maxsize' to None or nil for no limit, or a count >= 0."""
+    if maxsize is None or maxsize is nil:
+      maxsize = None
+    elif (not isinstance(maxsize, (int, long)) or isinstance(maxsize, Bool)
+          or maxsize < 0):
+      raise ValueError('maxsize has to be nil or an integer >= 0, not %r'
+                       % (maxsize,))
+    self.maxsize = maxsize
+    self.trim()
+
+  def trim(self):
+    """Drop the least recently used results that don't fit 'maxsize'."""
+    if self.maxsize is not None:
+      while len(self.cache) > self.maxsize:
+        self.cache.popitem(last=False)
+
+  def getattr(self, attribute):
+    if attribute == 'hits':
+      return toObject(self.hits)
+    elif attribute == 'misses':
+      return toObject(self.misses)
+    elif attribute == 'currsize':
+      return toObject(len(self.cache))
+    elif attribute == 'maxsize':
+      return nil if self.maxsize is None else toObject(self.maxsize)
+    return super(Memoized, self).getattr(attribute)
+
+  def setattr(self, attribute, value):
+    if attribute == 'maxsize':
+      self.resize(value)
+      return value
+    return super(Memoized, self).setattr(attribute, value)
 
 class BuiltinForm(Object):
+  __slots__ = ('attributes', 'form', 'analyze', 'compile')
+
   def __init__(self, form):
+    self.attributes = None
     self.form = form
+    self.analyze = None
+    self.compile = None
+
+  def analyzer(self, analyze):
+    """Decorator to register how 'analyze' should compile this form.
+
+    'analyze' is called with the analysis env, whether the form is in
+    tail position and the raw arguments, and returns a closure taking
+    the scope to run in. Forms without one are called at runtime.
+    """
+    self.analyze = analyze
+    return analyze
+
+  def compiler(self, compile):
+    """Decorator to register how 'compile_ast' should compile this form.
+
+    'compile' is called with the analysis env, the Code to add
+    instructions to, whether the form is in tail position and the raw
+    arguments. The instructions it adds leave the value of the form on
+    the stack. Forms without one are run with their analyzer.
+    """
+    self.compile = compile
+    return compile
 
   def call(self, argscope, *rawargs):
-    return self.form(argscope, *rawargs)
+    result = self.form(argscope, *rawargs)
+    if isinstance(result, Tail):
+      result = result.scope.eval(result.ast)
+    return result
+
+class Tail(object):
+  """Returned by a form that wants 'ast' evaluated in tail position.
+
+  Scope.eval picks these up and keeps going in its own loop instead of
+  recursing, so forms like 'if' and 'cond' don't grow the Python stack.
+  """
+
+  __slots__ = ('scope', 'ast')
+
+  def __init__(self, scope, ast):
+    self.scope = scope
+    self.ast = ast
+
+class TailCall(object):
+  """Returned by compiled code for a call to a lambda in tail position.
 
-class ParseResult(tuple):
-  def __new__(cls, objects, source, filename=None):
-    self = super(ParseResult, cls).__new__(cls, objects)
+  Lambda.__call__ keeps calling these in a loop, so that compiled
+  iterative processes run in constant Python stack.
+  """
+
+  __slots__ = ('function', 'args', 'ast')
+
+  def __init__(self, function, args, ast):
+    self.function = function
+    self.args = args
+    self.ast = ast
+
+class ParseResult(list):
+  def __init__(self, objects, source, filename=None, offset=0, lineno=1):
+    super(ParseResult, self).__init__(objects)
     self.source = source
     self.filename = filename or '<unknown>'
-    return self
+
+    # 'source' may be just part of the file (see parse_iter). These are
+    # the position and line number in the file that it starts at.
+    self.offset = offset
+    self.lineno = lineno
+
+    self._line_starts = None
+
+  @property
+  def line_starts(self):
+    """Index in 'source' where each line starts. Built on first use."""
+    if self._line_starts is None:
+      starts = [0]
+      i = self.source.find('\n')
+      while i != -1:
+        starts.append(i + 1)
+        i = self.source.find('\n', i + 1)
+      self._line_starts = starts
+    return self._line_starts
+
+  def position_at(self, index):
+    """Line and column number in the file of position 'index'."""
+    return self.positions_at([index])[0]
+
+  def positions_at(self, indices):
+    """Like position_at, for a lot of positions at once."""
+    starts = self.line_starts
+    positions = []
+    for index in indices:
+      line = bisect.bisect_right(starts, index - self.offset) - 1
+      positions.append((self.lineno + line,
+                        index - self.offset - starts[line]))
+    return positions
 
   def location_message_at(self, index):
-    linestart = self.source.rfind('\n', 0, index) + 1
-    lineend = self.source.find('\n', index)
-    lineend = len(self.source) if lineend == -1 else lineend
-    line = self.source[linestart:lineend]
-    lineno = self.source.count('\n', 0, index) + 1
-    colno = index - linestart
+    lineno, colno = self.position_at(index)
+    starts = self.line_starts
+    line = lineno - self.lineno
+    lineend = starts[line + 1] - 1 if line + 1 < len(starts) else None
+    line = self.source[starts[line]:lineend]
     return ('In file %s, on line %d:\n%s\n%s*' %
             (self.filename, lineno, line, ' ' * colno))
 
@@ -176,197 +562,476 @@ def toObject(x):
   elif isinstance(x, (list, tuple)):
     return List(map(toObject, x))
   elif isinstance(x, bool):
-    return Bool(x)
+    return true if x else false
   elif isinstance(x, int):
     return Int(x)
   elif isinstance(x, float):
     return Float(x)
+  elif isinstance(x, (long, fractions.Fraction)):
+    return toNumber(x)
   else:
     raise ValueError('%s (%s) could not be converted to Object type' %
                      (x, type(x)))
 
-def parse(s, filename=None):
-  i = 0
+def toNumber(x):
+  """toObject for results that are usually a number."""
+  if type(x) is int:
+    return Int(x)
+  elif type(x) is float:
+    return Float(x)
+  elif type(x) is long:
+    return Long(x)
+  elif type(x) is fractions.Fraction:
+    # Arithmetic on Rationals gives Fractions, which may be whole.
+    if x.denominator == 1:
+      return toNumber(x.numerator)
+    return Rational(x)
+  return toObject(x)
+
+def toBool(x):
+  """toObject for results that are only used for their truth value."""
+  return true if x else false
+
+def tokenize(s):
+  """Split 's' into (kind, text, start, end) tuples in a single pass.
+
+  'kind' is the name of the TOKEN_RE group that matched. Spaces and
+  comments are dropped, and so are newlines inside parentheses. The
+  source starts with a newline token for the indent of the first line,
+  and ends with one for an empty indent.
+  """
+  return tokenize_lines([s])
+
+def tokenize_lines(lines):
+  """Like tokenize, but reads the source a line at a time from 'lines'.
+
+  Only the current line is held on to, or the current block comment if
+  it spans several lines.
+  """
+  buffer = ''
+  offset = 0 # Position of 'buffer' in the source.
   depth = 0
-  metastack = None
-  indentstack = None
-  lastline = None
-  listlocstack = []
-  indentlocstack = []
-
-  while True:
-    # Skip empty lines, comments, etc.
-    while True:
-      m = EMPTY_LINE_RE.match(s, i)
-      if m:
-        i = m.end()
-        continue
-
-      m = BLOCK_COMMENT_RE.match(s, i)
-      if m:
-        i = m.end()
-        continue
-
-      m = LINE_COMMENT_RE.match(s, i)
-      if m:
-        i = m.end()
+  comment = False # If true, 'buffer' starts with an unfinished comment.
+  lines = iter(lines)
+  eof = False
+  started = False
+
+  match = TOKEN_RE.match
+  while not eof:
+    line = next(lines, None)
+    if line is None:
+      eof = True
+    else:
+      buffer += line
+      if comment and '|#' not in line:
         continue
 
-      if s.startswith('\n', i):
-        i += 1
+    i = 0
+    if not started:
+      m = INDENT_RE.match(buffer)
+      if m.end() == len(buffer) and not eof:
         continue
-      break
-
-    # process a single logical line in the rest of this iteration.
-    m = INDENT_RE.match(s, i)
-    i = m.end()
-    indent = m.group()
-
-    if indentstack is None:
-      indentstack = [indent]
-      metastack = [[]]
-    else:
-      if indent in indentstack:
-        metastack[-1].append(lastline if len(lastline) > 1 else lastline[0])
-        while indent != indentstack[-1]:
-          # dedent
-          indentstack.pop()
-          list_ = metastack.pop()
-          list_.start = indentlocstack.pop()
-          list_.end = m.start()
-          metastack[-1].append(list_)
-      elif indent.startswith(indentstack[-1]):
-        # indent
-        indentlocstack.append(m.end())
-        metastack.append(lastline)
-        indentstack.append(indent)
-      else:
-        raise SyntaxError('Invalid indent: ' + repr(indent))
-
-    # Break if we hit end of string.
-    if i >= len(s):
-      break
-
-    stack = [[]]
-    while True:
-      # Skip spaces and comments.
-      # Also, if we are nested in parenthesis, we want
-      # to skip newlines as well.
-      while True:
-        m = SPACE_RE.match(s, i)
-        if m:
-          i = m.end()
-          continue
-
-        m = BLOCK_COMMENT_RE.match(s, i)
-        if m:
-          i = m.end()
-          continue
-
-        m = LINE_COMMENT_RE.match(s, i)
-        if m:
-          i = m.end()
-          continue
-
-        if i < len(s) and s[i] == '\n' and depth:
-          i += 1
-          continue
+      yield 'newline', m.group(), 0, m.end()
+      i = m.end()
+      started = True
+
+    comment = False
+    while i < len(buffer):
+      m = match(buffer, i)
+      if m is None:
+        raise SyntaxError(
+            'Unrecognized token: ' + UNKNOWN_RE.match(buffer, i).group())
+
+      kind = m.lastgroup
+      if kind == 'symbol' and buffer.startswith('#|', i):
+        # A block comment we haven't seen the end of yet.
+        if eof:
+          raise SyntaxError('Missing end of block comment')
+        comment = True
         break
 
-      # Break if we hit end of (logical) line.
-      if i >= len(s) or s[i] == '\n':
+      if kind == 'newline' and m.end() == len(buffer) and not eof:
+        # The indent of the next line is part of this token.
         break
 
-      # Extract a single token from this line.
-      if s[i] == '(':
-        stack.append([])
-        listlocstack.append(i)
-        i += 1
-        depth += 1
+      i = m.end()
+      if kind == 'space' or kind == 'comment':
         continue
-
-      if s[i] == ')':
-        if len(stack) <= 1:
-          raise SyntaxError('Missing open parenthesis')
-        list_ = List(stack.pop())
-        stack[-1].append(list_)
-        stack[-1][-1].start = listlocstack.pop()
-        i += 1
-        stack[-1][-1].end = i
-        depth -= 1
-        continue
-
-      m = FLOAT_RE.match(s, i)
-      if m:
-        stack[-1].append(Float(m.group()))
-        stack[-1][-1].start = m.start()
-        stack[-1][-1].end = m.end()
-        i = m.end()
-        continue
-
-      m = INT_RE.match(s, i)
-      if m:
-        stack[-1].append(Int(m.group()))
-        stack[-1][-1].start = m.start()
-        stack[-1][-1].end = m.end()
-        i = m.end()
-        continue
-
-      m = SYMBOL_RE.match(s, i)
-      if m:
-        stack[-1].append(Symbol(m.group()))
-        stack[-1][-1].start = m.start()
-        stack[-1][-1].end = m.end()
-        i = m.end()
-        continue
-
-      m = ATTRIBUTE_RE.match(s, i)
-      if m:
-        owner = stack[-1].pop()
-        stack[-1].append(toObject(
-            ['__attribute__', owner, Symbol(m.group()[1:])]))
-        stack[-1][-1].start = m.start()
-        stack[-1][-1].end = m.end()
-        i = m.end()
+      elif kind == 'newline':
+        if depth:
+          continue
+        yield kind, m.group()[1:], offset + m.start() + 1, offset + i
         continue
+      elif kind == 'open':
+        depth += 1
+      elif kind == 'close':
+        depth -= 1
+      yield kind, m.group(), offset + m.start(), offset + i
 
-      m = UNKNOWN_RE.match(s, i)
-      raise SyntaxError('Unrecognized token: ' + m.group())
+    buffer = buffer[i:]
+    offset += i
 
-    if len(stack) > 1:
-      raise SyntaxError('Missing close parenthesis')
+  yield 'newline', '', offset, offset
 
-    # Save the contents of this logical line until we see the
-    # indentation level of the next line.
-    lastline = List(stack[0])
-    lastline.start = lastline[0].start
+def parse(s, filename=None):
+  parse_result = ParseResult([], source=s, filename=filename)
+  parse_result.extend(
+      form for form, _ in parse_forms(tokenize(s), lambda: parse_result))
+  return parse_result
 
-  assert len(metastack) == 1, 'internal indentation processing error...'
+def parse_iter(lines, filename=None):
+  """Parse 'lines', yielding each top level form as soon as it is complete.
+
+  'lines' is an iterable of source lines, like an open file. Only the
+  source of the form being parsed is kept in memory, so each form gets
+  a ParseResult of its own with just its part of the source.
+  """
+  window = collections.deque() # Lines read since 'offset'.
+  def read():
+    for line in lines:
+      window.append(line)
+      yield line
+
+  offset = 0
+  lineno = 1
+  new_parse_result = lambda: ParseResult([], None, filename)
+  for form, end in parse_forms(tokenize_lines(read()), new_parse_result):
+    form.parse_result.append(form)
+    form.parse_result.source = ''.join(window)
+    form.parse_result.offset = offset
+    form.parse_result.lineno = lineno
+    yield form
+
+    # Forget the lines before the next form.
+    while window and offset + len(window[0]) <= end:
+      offset += len(window.popleft())
+      lineno += 1
+
+def parse_forms(tokens, new_parse_result):
+  """Build top level forms out of 'tokens', as tokenize produces them.
+
+  Yields (form, end) as soon as each form is complete, where 'end' is
+  where the line after the form starts.
+
+  Each node gets its location when it is built. Its parse_result comes
+  from calling 'new_parse_result' once for each top level form; it can
+  keep handing out the same one.
+  """
+  parse_result = new_parse_result()
+  metastack = None
+  indentstack = None
+  lastline = None
+  listlocstack = []
+  indentlocstack = []
 
-  parse_result = ParseResult(metastack[0], source=s, filename=filename)
+  # Tokens of the logical line we are in the middle of, nested by
+  # parentheses. None between lines.
+  stack = None
 
-  def annotate(ast):
-    ast.parse_result = parse_result
-    if isinstance(ast, List):
-      for child in ast:
-        annotate(child)
+  for kind, text, start, end in tokens:
+    if kind == 'newline':
+      if stack is None:
+        # Blank line, or only comments on it.
+        indent, indentstart, indentend = text, start, end
+        continue
 
-  for ast in parse_result:
-    annotate(ast)
+      if len(stack) > 1:
+        raise SyntaxError('Missing close parenthesis')
+
+      # Save the contents of this logical line until we see the
+      # indentation level of the next line.
+      lastline = List(stack[0])
+      lastline.start = lastline[0].start
+      lastline.end = lastline[-1].end
+      lastline.parse_result = parse_result
+      stack = None
+      indent, indentstart, indentend = text, start, end
+      continue
+
+    if stack is None:
+      # First token of a logical line; process its indentation.
+      if indentstack is None:
+        indentstack = [indent]
+        metastack = [[]]
+      else:
+        close_indent_blocks(indent, indentstart, indentend, lastline,
+                            indentstack, metastack, indentlocstack)
+        if metastack[0]:
+          for form in metastack[0]:
+            yield form, indentstart
+          del metastack[0][:]
+          parse_result = new_parse_result()
+      stack = [[]]
+
+    # Extract a single token from this line.
+    if kind == 'open':
+      stack.append([])
+      listlocstack.append(start)
+
+    elif kind == 'close':
+      if len(stack) <= 1:
+        raise SyntaxError('Missing open parenthesis')
+      list_ = List(stack.pop())
+      list_.start = listlocstack.pop()
+      list_.end = end
+      list_.parse_result = parse_result
+      stack[-1].append(list_)
+
+    elif kind == 'attribute':
+      owner = stack[-1].pop()
+      attribute = toObject(['__attribute__', owner, Symbol(text[1:])])
+      attribute.start = start
+      attribute.end = end
+      attribute.parse_result = parse_result
+      stack[-1].append(attribute)
 
+    else:
+      if kind == 'float':
+        token = Float(text)
+      elif kind == 'int':
+        try:
+          token = Int(text)
+        except OverflowError:
+          token = Long(text)
+      else:
+        token = Symbol(text)
+      token.start = start
+      token.end = end
+      token.parse_result = parse_result
+      stack[-1].append(token)
+
+  if indentstack is not None:
+    # Like a line with no indent at the very end of the file.
+    close_indent_blocks('', indentstart, indentend, lastline,
+                        indentstack, metastack, indentlocstack)
+    assert len(metastack) == 1, 'internal indentation processing error...'
+    for form in metastack[0]:
+      yield form, indentstart
+
+def close_indent_blocks(indent, start, end, lastline,
+                        indentstack, metastack, indentlocstack):
+  """Place 'lastline' now that we know the indent of the line after it.
+
+  'start' and 'end' are where the indent of that line is in the source.
+  """
+  if indent in indentstack:
+    metastack[-1].append(lastline if len(lastline) > 1 else lastline[0])
+    while indent != indentstack[-1]:
+      # dedent
+      indentstack.pop()
+      list_ = metastack.pop()
+      list_.start = indentlocstack.pop()
+      list_.end = start
+      metastack[-1].append(list_)
+  elif indent.startswith(indentstack[-1]):
+    # indent
+    indentlocstack.append(end)
+    metastack.append(lastline)
+    indentstack.append(indent)
+  else:
+    raise SyntaxError('Invalid indent: ' + repr(indent))
+
+# Parsed files are cached in a __scmcache__ directory next to them, so
+# running the same file again doesn't have to tokenize it. Bump this
+# when the AST or the format of the cache changes.
+CACHE_VERSION = 2
+CACHE_MAGIC = b'PEMC'
+
+# Node types in the cache. Lists are tag 0.
+CACHE_TYPES = (List, Symbol, Int, Float, Long)
+CACHE_TAGS = dict((cls, tag) for tag, cls in enumerate(CACHE_TYPES))
+CACHE_VALUES = (tuple, str, int, float, long)
+
+# Caches are read and written whole, so files bigger than this (in
+# bytes) aren't cached, to keep to the memory parse_iter needs.
+CACHE_MAX_SIZE = 8 * 2 ** 20
+
+def cache_path(path):
+  """Where the cache for the file at 'path' goes."""
+  directory, name = os.path.split(path)
+  return os.path.join(directory, '__scmcache__', '%s.peme-py%d%d.scmc' %
+                      ((name,) + tuple(sys.version_info[:2])))
+
+def cache_key(source):
+  """Digest that a cache has to match to be used for 'source'."""
+  key = hashlib.sha1(('%d %s\n' % (CACHE_VERSION, sys.version)).encode())
+  key.update(source if isinstance(source, bytes) else source.encode('utf-8'))
+  return key.digest()
+
+def dump_ast(ast):
+  """'ast' as a flat tuple of nodes that marshal can write.
+
+  Each node is (tag, value, start, end, located), in prefix order. The
+  value of a list is how many children follow it. Being flat, deeply
+  nested asts need neither deep recursion here nor in marshal.
+  """
+  nodes = []
+  stack = [ast]
+  while stack:
+    ast = stack.pop()
+    tag = CACHE_TAGS[type(ast)]
+    if tag == 0:
+      value = len(ast)
+      stack.extend(reversed(ast))
+    else:
+      value = CACHE_VALUES[tag](ast)
+    nodes.append((tag, value, ast.start, ast.end,
+                  ast.parse_result is not None))
+  return tuple(nodes)
+
+def load_ast(nodes, parse_result):
+  """Rebuild an ast from what dump_ast returned."""
+  root = None
+  parents = [] # [list, number of its children still to come]
+  for tag, value, start, end, located in nodes:
+    ast = List() if tag == 0 else CACHE_TYPES[tag](value)
+    # Int and Symbol only get a __dict__ when something is set on them.
+    if start is not None:
+      ast.start = start
+    if end is not None:
+      ast.end = end
+    if located:
+      ast.parse_result = parse_result
+
+    if parents:
+      parent = parents[-1]
+      parent[0].append(ast)
+      parent[1] -= 1
+      if not parent[1]:
+        parents.pop()
+    else:
+      root = ast
+    if tag == 0 and value:
+      parents.append([ast, value])
+  return root
+
+def load_cache(path, source, key):
+  """Forms of 'source' from the cache of 'path', or None if it's not valid."""
+  try:
+    with open(cache_path(path), 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    return None # No cache (or an empty one).
+
+  try:
+    header = len(CACHE_MAGIC) + len(key)
+    if data[:header] != CACHE_MAGIC + key:
+      return None
+    forms = marshal.loads(data[header:])
+  except (EOFError, ValueError, TypeError):
+    return None
+  finally:
+    data.close()
+
+  parse_result = ParseResult([], source, path)
+  parse_result.extend(load_ast(form, parse_result) for form in forms)
   return parse_result
 
+def save_cache(path, key, forms):
+  """Write 'forms' to the cache of 'path'. Gives up quietly on errors."""
+  filename = cache_path(path)
+  try:
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    # Write a temporary file and move it in place, so nobody reads a
+    # half written cache. tempfile is imported here, as most runs never
+    # write a cache and it is slow to import.
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+      f.write(CACHE_MAGIC + key)
+      marshal.dump(tuple(map(dump_ast, forms)), f)
+    os.rename(tmp, filename)
+  except (EnvironmentError, ValueError):
+    pass # ValueError is marshal not being able to write something.
+
+def parse_path(path, cache=True):
+  """Like parse_iter for the file at 'path', but uses its cache.
+
+  If the cache is up to date, the forms come from there. Otherwise the
+  file is parsed as usual, and the cache written once all of it has
+  been parsed. Files bigger than CACHE_MAX_SIZE, or all of them without
+  'cache', are streamed through parse_iter straight from the file.
+  """
+  if not cache or os.path.getsize(path) > CACHE_MAX_SIZE:
+    with open(path) as f:
+      for form in parse_iter(f, path):
+        yield form
+    return
+
+  with open(path) as f:
+    source = f.read()
+  key = cache_key(source)
+  forms = load_cache(path, source, key)
+  if forms is not None:
+    for form in forms:
+      yield form
+    return
+
+  forms = []
+  for form in parse_iter(source.splitlines(True), path):
+    forms.append(form)
+    yield form
+  save_cache(path, key, forms)
+
+# Value of a slot for a name that a lambda body defines, before the
+# 'define' has run.
+unassigned = object()
+
+class Context(object):
+  """State of one interpreter, shared by all the scopes it creates.
+
+  Every Scope holds on to its Context directly, so getting at the
+  callstack doesn't depend on how deeply the scope is nested, and
+  separate interpreters don't share any of this.
+  """
+
+  def __init__(self, root):
+    self.root = root # Scope with the globals.
+    # TODO: Add an option where it's not debug mode, but allow
+    #       Python code to catch the exception.
+    self.debug = False # If true, will also dump Python stacktrace on error.
+    # If true, calls to lambdas in tail position reuse the current
+    # Python stack frame. Turn off to keep every call on the callstack.
+    self.tailcalls = True
+    self.engine = 'closure' # One of ENGINES.
+    # If true, don't keep track of the callstack while running. It gets
+    # pieced together from the Python traceback if something goes wrong.
+    # Only applies to code analyzed after it is set.
+    self.fast = False
+    self.callstack = []
+    self.current = None
+    self.stacktrace = None # snapshot of the callstack when we crash.
+    # Standard library to load right before running anything for the
+    # first time, if any. See 'bootstrap'.
+    self.stdlib = None
+    self.bootstrapped = False
+    self.snapshot = None # The globals right after bootstrapping.
+    # Scope.eval caches the global a call resolves its function to, in
+    # the call's ast, along with this context and 'version'. Binding
+    # any of the names in 'cached' anywhere bumps 'version', which
+    # throws all of those caches out. Names in 'local' have been bound
+    # below the globals, so the global isn't necessarily what they
+    # resolve to, and aren't cached.
+    self.version = 0
+    self.cached = set()
+    self.local = set()
+
 class Scope(object):
-  def __init__(self, parent=None, table=None):
+  __slots__ = ('parent', '_table', 'slots', 'values', 'context')
+
+  def __init__(self, parent=None, table=None, slots=None, values=None):
     self.parent = parent
     self._table = table or dict()
-    if parent is None:
-      # TODO: Add an option where it's not debug mode, but allow
-      #       Python code to catch the exception.
-      self.debug = False # If true, will also dump Python stacktrace on error.
-      self.callstack = []
-      self.current = None
-      self.stacktrace = None # snapshot of the callstack when we crash.
+
+    # Compiled lambdas keep their arguments and the names their body
+    # defines in 'values', at the index 'slots' maps the name to.
+    # Anything declared on top of that goes in '_table'.
+    self.slots = slots
+    self.values = values
+
+    # A scope without a parent starts a new interpreter.
+    self.context = Context(self) if parent is None else parent.context
 
   def __call__(self, code):
     if isinstance(code, str):
@@ -377,59 +1042,109 @@ class Scope(object):
                        'pass either a parsable string or a ParseResult '
                        'instance. Instead you passed a %s' % type(code))
 
+    self.run_stream(code)
+
+  def run_stream(self, forms):
+    """Run each ast from the iterable 'forms' as soon as it comes in.
+
+    Pair with parse_iter to start running a script before all of it
+    has been parsed.
+    """
     try:
-      for ast in code:
-        self.eval(ast)
+      for ast in forms:
+        self.run(ast)
     except Exception as e:
-      if self.root.stacktrace is not None:
-        for ast in self.root.stacktrace:
-          print(ast.location_message)
-      print(repr(e))
+      print(self.failure(e, sys.exc_info()[2]))
 
-      if self.debug:
+      if self.context.debug:
         raise
       else:
         exit(1)
 
+  def failure(self, e, traceback):
+    """Where the calls in progress were when 'e' was raised, and 'e'.
+
+    'traceback' is the Python traceback of 'e', which is where the
+    stacktrace comes from in fast mode.
+    """
+    stacktrace = self.context.stacktrace
+    if self.context.fast:
+      stacktrace = stacktrace_from(traceback)
+    lines = [ast.location_message for ast in stacktrace or ()]
+    return '\n'.join(lines + [repr(e)])
+
+  def run(self, ast):
+    """Evaluate 'ast' in this scope with the engine set on the context."""
+    if not self.context.bootstrapped:
+      bootstrap(self)
+    engine = self.context.engine
+    if engine == 'tree':
+      return self.eval(ast)
+    elif engine == 'vm':
+      return compile_toplevel(ast, Environment.of(self))(self)
+    return analyze(ast, Environment.of(self))(self)
+
   @property
   def root(self):
-    return self if self.parent is None else self.parent.root
+    return self.context.root
 
   def declare(self, symbol, value):
     assert isinstance(symbol, Symbol)
-    self._table[symbol] = value
+    if self.slots is not None and symbol in self.slots:
+      self.values[self.slots[symbol]] = value
+    else:
+      self._table[symbol] = value
+      context = self.context
+      if self.parent is not None:
+        context.local.add(symbol)
+      if symbol in context.cached:
+        context.version += 1
     return value
 
   def __getitem__(self, symbol):
     assert isinstance(symbol, Symbol)
-    if symbol in self._table:
-      return self._table[symbol]
-    elif self.parent:
-      return self.parent[symbol]
-    else:
-      raise KeyError('unrecognized symbol: ' + symbol)
+    scope = self
+    while scope is not None:
+      if symbol in scope._table:
+        return scope._table[symbol]
+      if scope.slots is not None and symbol in scope.slots:
+        value = scope.values[scope.slots[symbol]]
+        if value is not unassigned:
+          return value
+      scope = scope.parent
+    raise KeyError('unrecognized symbol: ' + symbol)
 
   def __setitem__(self, symbol, value):
     assert isinstance(symbol, Symbol)
-    if symbol in self._table:
-      self._table[symbol] = value
-    elif self.parent:
-      self.parent[symbol] = value
-    else:
-      raise KeyError('assignment to unrecognized symbol: ' + symbol)
+    if symbol in self.context.cached:
+      self.context.version += 1
+    scope = self
+    while scope is not None:
+      if symbol in scope._table:
+        scope._table[symbol] = value
+        return
+      if (scope.slots is not None and symbol in scope.slots and
+          scope.values[scope.slots[symbol]] is not unassigned):
+        scope.values[scope.slots[symbol]] = value
+        return
+      scope = scope.parent
+    raise KeyError('assignment to unrecognized symbol: ' + symbol)
 
   def __contains__(self, symbol):
-    assert isinstance(symbol, Symbol)
-    if symbol in self._table:
-      return True
-    elif self.parent:
-      return self.parent(symbol)
-    else:
+    try:
+      self[symbol]
+    except KeyError:
       return False
+    return True
 
-  def setfunc(self, name):
+  def setfunc(self, name, returns=toObject):
+    """Decorator to declare a builtin function.
+
+    'returns' converts its results to Objects. Functions that already
+    return Objects pass None, and their results are used as they are.
+    """
     def wrapper(func):
-      return self.declare(Symbol(name), BuiltinFunction(func))
+      return self.declare(Symbol(name), BuiltinFunction(func, returns))
     return wrapper
 
   def setform(self, name):
@@ -438,44 +1153,930 @@ class Scope(object):
     return wrapper
 
   def eval(self, ast):
-    assert isinstance(ast, Object), ast
-    self.root.current = ast
-    if isinstance(ast, List):
-      form = self.eval(ast[0])
-      # TODO: The if and else branch of the following if-else
-      #       pairs are very similar. Figure out a clean way
-      #       to deduplicate.
-      if isinstance(form, Function):
-        args = tuple(map(self.eval, ast[1:]))
-        self.root.callstack.append(ast)
-        try:
-          return toObject(form(*args))
-        except:
-          if self.root.stacktrace is None:
-            self.root.stacktrace = tuple(self.root.callstack)
-          raise
-        finally:
-          self.root.callstack.pop()
-      else:
-        # TODO: Better error message machanism for general forms.
-        #       We might need some mechanism for forms to indicate
-        #       that it is done 'eval'ing all the arguments it
-        #       wants to.
-        self.root.callstack.append(ast)
-        try:
-          return toObject(form.call(self, *ast[1:]))
-        except:
-          if self.root.stacktrace is None:
-            self.root.stacktrace = tuple(self.root.callstack)
-          raise
-        finally:
-          self.root.callstack.pop()
-    elif isinstance(ast, Symbol):
-      return self[ast]
-    elif isinstance(ast, (Int, Float)):
-      return ast
+    # Calls in tail position (the last expression in a lambda body, or
+    # an ast handed back by a form as a Tail) are run by looping here
+    # instead of recursing, so iterative processes run in constant
+    # Python stack. The callstack entry for this eval is reused by each
+    # subsequent tail call to a lambda. Other calls that the loop gets to
+    # go on top of it, as they would if they weren't in tail position.
+    context = self.context
+    tracking = not context.fast
+    scope = self
+    pushed = 0 # Callstack entries to pop when done.
+    try:
+      while True:
+        assert isinstance(ast, Object), ast
+        if tracking:
+          context.current = ast
+        if isinstance(ast, Symbol):
+          return scope[ast]
+        elif isinstance(ast, Number):
+          return ast
+        elif not isinstance(ast, List):
+          raise ValueError('Unknown ast type: %s' % type(ast))
+
+        # Calls to globals skip looking up the function and working out
+        # what kind it is, as long as nothing rebinds the name. Parsed
+        # code can be run by more than one interpreter, so the cache
+        # only counts for the one that filled it.
+        cache = ast.cache
+        if (cache is not None and cache[0] is context and
+            cache[1] == context.version):
+          _, _, form, kind = cache
+        else:
+          head = ast[0]
+          form = scope.eval(head)
+          kind = call_kind(form)
+          if (isinstance(head, Symbol) and head not in context.local and
+              context.root._table.get(head) is form):
+            context.cached.add(head)
+            ast.cache = (context, context.version, form, kind)
+
+        if kind != FORM_CALL:
+          args = tuple(map(scope.eval, ast[1:]))
+
+        if not tracking:
+          pass
+        elif not pushed:
+          context.callstack.append(ast)
+          pushed = 1
+        elif kind == LAMBDA_CALL and context.tailcalls:
+          context.callstack[-1] = ast
+        elif kind != FORM_CALL:
+          context.callstack.append(ast)
+          pushed += 1
+
+        if kind == LAMBDA_CALL and context.tailcalls:
+          if not form.body:
+            form.bind(args)
+            return nil
+          scope = form.bind(args)
+          for expr in form.body[:-1]:
+            scope.eval(expr)
+          ast = form.body[-1]
+        elif kind == BUILTIN_CALL:
+          # Same as BuiltinFunction.__call__, but saves a Python frame.
+          value = form.function(*args)
+          return value if form.returns is None else form.returns(value)
+        elif kind != FORM_CALL:
+          return form(*args)
+        else:
+          # TODO: Better error message machanism for general forms.
+          #       We might need some mechanism for forms to indicate
+          #       that it is done 'eval'ing all the arguments it
+          #       wants to.
+          result = form.form(scope, *ast[1:])
+          if not isinstance(result, Tail):
+            return toObject(result)
+          scope = result.scope
+          ast = result.ast
+    except:
+      if pushed and context.stacktrace is None:
+        context.stacktrace = tuple(context.callstack)
+      raise
+    finally:
+      if pushed:
+        del context.callstack[-pushed:]
+
+ENGINES = ('closure', 'tree', 'vm')
+
+# How Scope.eval calls something, by what 'call_kind' says it is.
+FORM_CALL, BUILTIN_CALL, LAMBDA_CALL, FUNCTION_CALL = range(4)
+
+def call_kind(form):
+  if type(form) is BuiltinFunction:
+    return BUILTIN_CALL
+  elif isinstance(form, Lambda) and form.code is None:
+    return LAMBDA_CALL
+  elif isinstance(form, Function):
+    return FUNCTION_CALL
+  return FORM_CALL
+
+def stacktrace_from(traceback):
+  """Piece together the Scheme callstack from a Python traceback.
+
+  In fast mode nothing keeps track of the callstack, but the calls that
+  were in progress when the exception was raised still have their
+  Python frames in the traceback.
+  """
+  stacktrace = []
+  while traceback is not None:
+    frame = traceback.tb_frame
+    if frame.f_globals is globals():
+      if frame.f_code.co_name == 'execute_call':
+        stacktrace.append(frame.f_locals['call'])
+      elif frame.f_code.co_name == 'execute_assert':
+        stacktrace.append(frame.f_locals['condition'])
+      elif (frame.f_code.co_name == 'eval' and
+            isinstance(frame.f_locals.get('ast'), List)):
+        stacktrace.append(frame.f_locals['ast'])
+      elif frame.f_code.co_name == 'run_code':
+        locals_ = frame.f_locals
+        calls = [saved[3] for saved in locals_['frames']]
+        calls += [locals_['call'], locals_['pending']]
+        if locals_.get('opcode') == ASSERT:
+          calls.append(locals_['argument'])
+        stacktrace.extend(call for call in calls if call is not None)
+    traceback = traceback.tb_next
+  return tuple(stacktrace)
+
+class Profiler(object):
+  """Where an interpreter spends its time, by Scheme procedure and line.
+
+  Calls are counted exactly: while the profiler runs, Lambda.bind is
+  wrapped to count every call of every lambda, and to remember which
+  lambda each call on the callstack went to. Time is sampled: every
+  'interval' seconds of CPU time, SIGPROF takes a snapshot of the
+  callstack. The procedure on top of it gets exclusive time, every
+  procedure in it gets inclusive time, and the line of the call on top
+  gets a hit. Needs the callstack, so it doesn't work with 'fast'.
+  """
+
+  def __init__(self, context, interval=0.001):
+    self.context = context
+    self.interval = interval
+    self.calls = collections.Counter() # Lambda -> number of calls.
+    self.names = {} # Lambda -> name in the report.
+    self.callees = {} # id of a call ast -> (ast, Lambda it last called).
+    self.stacks = collections.Counter() # Tuple of names -> samples.
+    self.lines = collections.Counter() # (filename, line) -> samples.
+    self.samples = 0
+    self.sources = {} # (filename, line) -> ParseResult it's in.
+    self._bind = None
+    self._handler = None
+
+  def start(self):
+    import signal
+    if not hasattr(signal, 'setitimer'):
+      raise ValueError('Profiling needs signal.setitimer, which this '
+                       'platform does not have')
+    profiler = self
+    bind = self._bind = Lambda.bind
+
+    def counting_bind(self, args):
+      if self.parentscope.context is profiler.context:
+        profiler.called(self)
+      return bind(self, args)
+
+    Lambda.bind = counting_bind
+    self._handler = signal.signal(signal.SIGPROF, self.sample)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+  def stop(self):
+    import signal
+    signal.setitimer(signal.ITIMER_PROF, 0)
+    signal.signal(signal.SIGPROF, self._handler)
+    Lambda.bind = self._bind
+
+  def called(self, function):
+    self.calls[function] += 1
+    callstack = self.context.callstack
+    if callstack:
+      call = callstack[-1]
+      # 'sample' can run between any two of these lines, so the name
+      # has to be there before anything refers to it.
+      if function not in self.names:
+        # The arglist is on the line of the lambda or define. The body
+        # may only start on the line after it.
+        where = self.where([function.arglist] + list(function.body))
+        self.names[function] = '%s %s' % (self.defined_as(function, call),
+                                          where)
+      self.callees[id(call)] = (call, function)
+
+  def defined_as(self, function, call):
+    """Global name of 'function', or what 'call' calls it."""
+    for name, value in self.context.root._table.items():
+      if value is function or (isinstance(value, Memoized) and
+                               value.function is function):
+        return name
+    head = call[0] if isinstance(call, List) and call else None
+    return head if isinstance(head, Symbol) else 'lambda'
+
+  def where(self, asts):
+    """'file:line' of the first of 'asts' that has a location."""
+    for ast in asts:
+      if getattr(ast, 'parse_result', None) is not None:
+        line, _ = ast.parse_result.position_at(ast.start)
+        return '%s:%d' % (ast.parse_result.filename, line)
+    return '<unknown>'
+
+  def name(self, call):
+    """What to call the procedure 'call' is running in the report."""
+    callee = self.callees.get(id(call))
+    if callee is not None and callee[0] is call:
+      return self.names[callee[1]]
+    head = call[0] if isinstance(call, List) and call else call
+    return str(head)
+
+  def sample(self, signum, frame):
+    self.samples += 1
+    # This runs in a signal handler, in the middle of whatever the script
+    # was doing, so nothing may go wrong here that the script would see.
+    try:
+      self.record(tuple(self.context.callstack))
+    except Exception:
+      self.stacks[('<unknown>',)] += 1
+
+  def record(self, callstack):
+    """Count one sample of 'callstack'."""
+    if not callstack:
+      self.stacks[('<toplevel>',)] += 1
+      return
+    self.stacks[tuple(self.name(call) for call in callstack)] += 1
+    call = callstack[-1]
+    if call.parse_result is not None:
+      line, _ = call.parse_result.position_at(call.start)
+      key = (call.parse_result.filename, line)
+      self.lines[key] += 1
+      self.sources.setdefault(key, call.parse_result)
+
+  def report(self, out=sys.stdout, limit=20):
+    """Print the procedures and lines that took the most time."""
+    inclusive = collections.Counter()
+    exclusive = collections.Counter()
+    for stack, count in self.stacks.items():
+      exclusive[stack[-1]] += count
+      for name in set(stack):
+        inclusive[name] += count
+    calls = collections.Counter()
+    for function, count in self.calls.items():
+      calls[self.names.get(function, 'lambda <unknown>')] += count
+
+    out.write('%d samples, %.3fs each\n\n' % (self.samples, self.interval))
+    out.write('%10s %10s %10s  %s\n' %
+              ('calls', 'inclusive', 'exclusive', 'procedure'))
+    names = sorted(set(inclusive) | set(calls),
+                   key=lambda name: (-inclusive[name], -calls[name], name))
+    for name in names[:limit]:
+      out.write('%10s %9.3fs %9.3fs  %s\n' %
+                (calls[name] if name in calls else '-',
+                 inclusive[name] * self.interval,
+                 exclusive[name] * self.interval, name))
+
+    out.write('\n%10s %10s  %s\n' % ('samples', 'time', 'line'))
+    for (filename, line), count in self.lines.most_common(limit):
+      source = self.sources[filename, line]
+      starts = source.line_starts
+      index = line - source.lineno
+      end = starts[index + 1] - 1 if index + 1 < len(starts) else None
+      out.write('%10d %9.3fs  %s:%d: %s\n' %
+                (count, count * self.interval, filename, line,
+                 source.source[starts[index]:end].strip()))
+
+  def write_collapsed(self, path):
+    """Write the sampled stacks in the format flame graph tools read.
+
+    One line per distinct stack, outermost call first, separated by
+    ';', followed by how many samples had that stack.
+    """
+    with open(path, 'w') as f:
+      for stack, count in sorted(self.stacks.items()):
+        f.write('%s %d\n' % (';'.join(stack), count))
+
+class CountingCallstack(list):
+  """A callstack that counts the calls put on it. See 'count_evals'."""
+
+  def __init__(self, calls=()):
+    super(CountingCallstack, self).__init__(calls)
+    self.count = 0
+
+  def append(self, ast):
+    self.count += 1
+    list.append(self, ast)
+
+  def __setitem__(self, index, ast):
+    # Tail calls reuse the entry of the call they replace.
+    self.count += 1
+    list.__setitem__(self, index, ast)
+
+def count_evals(scope=None):
+  """Start counting the evaluations in the interpreter of 'scope'.
+
+  What gets counted are the calls that go on the callstack: calls to
+  lambdas, builtins and forms. Scope.eval also puts the forms in tail
+  position of a lambda's body there, so the tree engine counts a few
+  more than the others. Returns the counter, whose 'count' goes up
+  from then on. Nothing is counted in fast mode, which has no
+  callstack.
+  """
+  context = (root if scope is None else scope).context
+  if context.fast:
+    raise ValueError("Evaluations are counted on the callstack, which "
+                     "isn't kept in fast mode")
+  if not isinstance(context.callstack, CountingCallstack):
+    context.callstack = CountingCallstack(context.callstack)
+  return context.callstack
+
+class Environment(object):
+  """What 'analyze' knows about the scopes analyzed code will run in.
+
+  Below the globals, each Environment stands for the Scope of a call to
+  one compiled lambda, with a slot for each argument and for each name
+  its body defines. That lets 'analyze' turn a symbol into a (depth,
+  slot) address instead of searching the scope chain by name.
+
+  If 'scope' is given, the code runs in that scope, which isn't known
+  statically, and names that reach it are looked up by name.
+  """
+
+  def __init__(self, root, parent=None, names=(), scope=None):
+    self.root = root
+    self.parent = parent
+    self.scope = scope
+    self.slots = dict((name, slot) for slot, name in enumerate(names))
+    self.arguments = len(names) # Slots that get bound to arguments.
+    self.padding = () # Initial values of the slots after the arguments.
+
+  @classmethod
+  def of(cls, scope):
+    """Environment for code that runs directly in 'scope'."""
+    root = scope.root
+    return cls(root) if scope is root else cls(root, scope=scope)
+
+  def child(self, argnames, body):
+    """Environment for a lambda with 'argnames' and 'body' defined here."""
+    names = list(argnames)
+    defines = [name for name in defined_names(body) if name not in names]
+    env = Environment(self.root, self, names + defines)
+    env.arguments = len(names)
+    env.padding = [unassigned] * len(defines)
+    # Slots get bound without 'declare', so tell Scope.eval about them
+    # here.
+    context = self.root.context
+    context.local.update(env.slots)
+    if not context.cached.isdisjoint(env.slots):
+      context.version += 1
+    return env
+
+  def resolve(self, symbol):
+    """Find where 'symbol' lives, as seen from code in this environment.
+
+    Returns (depth, slot) for names in a slot 'depth' scopes up,
+    (depth, None) if it has to be looked up by name starting 'depth'
+    scopes up, and None for globals.
+    """
+    env = self
+    depth = 0
+    while env.parent is not None:
+      slot = env.slots.get(symbol)
+      if slot is not None:
+        return depth, slot
+      env = env.parent
+      depth += 1
+    if env.scope is not None:
+      return depth, None
+    return None
+
+  def form(self, symbol):
+    """The BuiltinForm 'symbol' refers to at analysis time, if any."""
+    address = self.resolve(symbol)
+    if address is None:
+      form = self.root._table.get(symbol)
+    elif address[1] is None:
+      try:
+        form = self.ancestor(address[0]).scope[symbol]
+      except KeyError:
+        form = None
+    else:
+      form = None
+    return form if isinstance(form, BuiltinForm) else None
+
+  def ancestor(self, depth):
+    env = self
+    for _ in range(depth):
+      env = env.parent
+    return env
+
+  def assigned(self, slot):
+    """Whether 'slot' always has a value when code in here runs."""
+    return slot < self.arguments
+
+def defined_names(body):
+  """Names that 'define' forms in 'body' declare in the scope it runs in.
+
+  Doesn't look inside quotes or bodies of nested lambdas, since those
+  run in a scope of their own.
+  """
+  names = []
+  stack = list(reversed(body))
+  while stack:
+    ast = stack.pop()
+    if not isinstance(ast, List) or not ast:
+      continue
+    head = ast[0]
+    if head == 'quote' or head == 'lambda':
+      continue
+    elif (head == 'define' or head == 'define-memo') and len(ast) > 1:
+      if isinstance(ast[1], Symbol):
+        names.append(ast[1])
+        stack.extend(reversed(ast[2:]))
+      elif isinstance(ast[1], List) and ast[1]:
+        names.append(ast[1][0])
+    elif head == 'set!' and len(ast) > 1 and isinstance(ast[1], List):
+      # (set! (owner.attribute args...) body...) defines a method, but
+      # 'owner' is still evaluated here.
+      stack.extend(reversed(ast[1][:1] if ast[1] and isattr(ast[1][0]) else
+                            ast[1:]))
+    else:
+      stack.extend(reversed(ast))
+
+  unique = []
+  for name in names:
+    if name not in unique:
+      unique.append(name)
+  return unique
+
+def analyze_lookup(symbol, env):
+  """Analyze a reference to the variable 'symbol'."""
+  address = env.resolve(symbol)
+  if address is None:
+    table = env.root._table
+    def execute(scope):
+      try:
+        return table[symbol]
+      except KeyError:
+        # Maybe something declared it in a scope in between at runtime.
+        return scope[symbol]
+    return execute
+
+  depth, slot = address
+  if slot is None:
+    def execute(scope):
+      for _ in range(depth):
+        scope = scope.parent
+      return scope[symbol]
+    return execute
+
+  # Slots for names the body defines are unassigned until the 'define'
+  # runs. Until then, the name refers to whatever is further out.
+  if env.ancestor(depth).assigned(slot):
+    if depth == 0:
+      return lambda scope: scope.values[slot]
+    elif depth == 1:
+      return lambda scope: scope.parent.values[slot]
+
+  def execute(scope):
+    for _ in range(depth):
+      scope = scope.parent
+    value = scope.values[slot]
+    if value is unassigned:
+      return scope.parent[symbol]
+    return value
+  return execute
+
+def analyze(ast, env, tail=False):
+  """Analyze 'ast' into a Python closure that takes the scope to run in.
+
+  This is the split between syntax analysis and execution from SICP
+  4.1.7: dispatching on node types, picking out special forms and
+  resolving variables to slots happens once here instead of on every
+  evaluation. 'env' is the Environment the code will run in.
+
+  If 'tail' is true, the closure may return a TailCall instead of a
+  value.
+  """
+  if isinstance(ast, Symbol):
+    return analyze_lookup(ast, env)
+  elif isinstance(ast, Number):
+    return lambda scope: ast
+  elif not isinstance(ast, List):
+    raise ValueError('Unknown ast type: %s' % type(ast))
+
+  head = ast[0]
+  rawargs = tuple(ast[1:])
+  if isinstance(head, Symbol):
+    form = env.form(head)
+    if form is not None and form.analyze is not None:
+      try:
+        return form.analyze(env, tail, *rawargs)
+      except (TypeError, ValueError):
+        # Malformed forms only raise once they are actually evaluated,
+        # like they would with the tree walker. The runtime fallback
+        # below takes care of that.
+        pass
+
+  fproc = analyze(head, env)
+  argprocs = tuple(analyze(arg, env) for arg in rawargs)
+
+  if env.root.context.fast:
+    tailcalls = tail and env.root.context.tailcalls
+
+    # No callstack here. If something goes wrong, stacktrace_from finds
+    # the calls in progress by looking for these frames, and reads the
+    # call out of 'call'.
+    def execute_call(scope):
+      call = ast
+      form = fproc(scope)
+      if not isinstance(form, Function):
+        return toObject(form.call(scope, *rawargs))
+
+      # Not a list comprehension: before Python 3.12 that is a frame of
+      # its own, which would cost a Python frame per level of calls.
+      args = []
+      for proc in argprocs:
+        args.append(proc(scope))
+      if not isinstance(form, Lambda) or form.code is None:
+        return form(*args)
+      if tailcalls:
+        return TailCall(form, args, ast)
+
+      result = form.code(form.bind(args))
+      while isinstance(result, TailCall):
+        call = result.ast
+        form = result.function
+        result = form.code(form.bind(result.args))
+      return result
+
+    return execute_call
+
+  def execute(scope):
+    form = fproc(scope)
+    context = scope.context
+    context.current = ast
+    if isinstance(form, Function):
+      args = []
+      for proc in argprocs:
+        args.append(proc(scope))
+      if (tail and isinstance(form, Lambda) and form.code is not None and
+          context.tailcalls):
+        return TailCall(form, args, ast)
+      context.callstack.append(ast)
+      try:
+        if not isinstance(form, Lambda) or form.code is None:
+          return form(*args)
+
+        # Same as Lambda.__call__, but saves a Python frame per call.
+        result = form.code(form.bind(args))
+        while isinstance(result, TailCall):
+          context.callstack[-1] = result.ast
+          form = result.function
+          result = form.code(form.bind(result.args))
+        return result
+      except:
+        if context.stacktrace is None:
+          context.stacktrace = tuple(context.callstack)
+        raise
+      finally:
+        context.callstack.pop()
+    else:
+      # Forms without an analyzer, or forms we only find at runtime,
+      # get their raw arguments like they would from Scope.eval.
+      context.callstack.append(ast)
+      try:
+        return toObject(form.call(scope, *rawargs))
+      except:
+        if context.stacktrace is None:
+          context.stacktrace = tuple(context.callstack)
+        raise
+      finally:
+        context.callstack.pop()
+
+  return execute
+
+def analyze_body(body, env):
+  """Analyze a sequence of asts, where the last one is in tail position."""
+  if not body:
+    return lambda scope: nil
+
+  procs = tuple(analyze(ast, env) for ast in body[:-1])
+  last = analyze(body[-1], env, tail=True)
+  if not procs:
+    return last
+
+  def execute(scope):
+    for proc in procs:
+      proc(scope)
+    return last(scope)
+  return execute
+
+# Instructions for the 'vm' engine. Each is an (opcode, argument) pair.
+OPCODES = (
+    'CONST',                # push argument
+    'LOAD',                 # push variable at (depth, slot, symbol)
+    'LOAD_GLOBAL',          # LOAD for a name that isn't in any slot
+    'LOAD_ARG',             # LOAD for an argument of the current lambda
+    'STORE',                # set variable at (depth, slot, symbol, define)
+                            # to the top of the stack
+    'POP',                  # drop the top of the stack
+    'CALL',                 # call with (argc, ast); pops the args and
+                            # the function under them, pushes the result
+    'TAILCALL',             # same, but replaces the current frame
+    'RETURN',               # return the top of the stack to the caller
+    'JUMP',                 # continue at argument
+    'JUMP_IF_FALSE',        # pop, and jump if it is false
+    'JUMP_IF_FALSE_OR_POP', # jump if false, else pop
+    'JUMP_IF_TRUE_OR_POP',  # jump if true, else pop
+    'MAKE_CLOSURE',         # push Lambda for (argnames, body, vararg,
+                            # code, environment) closing over the scope
+    'GETATTR',              # replace the top of the stack with its
+                            # attribute named by argument
+    'ASSERT',               # raise AssertionError(argument) if the top
+                            # of the stack is false
+    'ANALYZED',             # push result of argument, a closure made by
+                            # 'analyze', called with the scope
+)
+(CONST, LOAD, LOAD_GLOBAL, LOAD_ARG, STORE, POP, CALL, TAILCALL, RETURN, JUMP,
+ JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, MAKE_CLOSURE,
+ GETATTR, ASSERT, ANALYZED) = range(len(OPCODES))
+
+class Code(object):
+  """A flat list of instructions for 'run_code' to run.
+
+  A Code runs a whole lambda body or top level form, and ends in
+  RETURN. Like the closures from 'analyze', it is called with the scope
+  to run in, so Lambda.__call__ and the other engines can call lambdas
+  that were compiled for the vm.
+  """
+
+  __slots__ = ('instructions',)
+
+  def __init__(self):
+    self.instructions = []
+
+  def emit(self, opcode, argument=None):
+    """Add an instruction, and return its index."""
+    self.instructions.append((opcode, argument))
+    return len(self.instructions) - 1
+
+  def patch(self, index, argument):
+    """Set the argument of the (jump) instruction at 'index'."""
+    self.instructions[index] = (self.instructions[index][0], argument)
+
+  def __call__(self, scope):
+    return run_code(self, scope)
+
+  def __repr__(self):
+    return '\n'.join('%4d %-20s %r' % (i, OPCODES[opcode], argument)
+                     for i, (opcode, argument) in enumerate(self.instructions))
+
+def compile_ast(ast, env, code, tail=False):
+  """Add instructions to 'code' that push the value of 'ast'.
+
+  This is the 'vm' engine's counterpart of 'analyze', and resolves
+  names with the same Environments. If 'tail' is true, calls may be
+  compiled to TAILCALL.
+  """
+  if isinstance(ast, Symbol):
+    address = env.resolve(ast)
+    if address is None:
+      code.emit(LOAD_GLOBAL, ast)
+    elif address[0] == 0 and env.assigned(address[1]):
+      code.emit(LOAD_ARG, address[1])
     else:
-      raise ValueError('Unknown ast type: %s' % type(ast))
+      code.emit(LOAD, address + (ast,))
+    return
+  elif isinstance(ast, Number):
+    code.emit(CONST, ast)
+    return
+  elif not isinstance(ast, List):
+    raise ValueError('Unknown ast type: %s' % type(ast))
+
+  head = ast[0]
+  rawargs = tuple(ast[1:])
+  if isinstance(head, Symbol):
+    form = env.form(head)
+    if form is not None and form.compile is not None:
+      start = len(code.instructions)
+      try:
+        form.compile(env, code, tail, *rawargs)
+        return
+      except (TypeError, ValueError):
+        # Malformed form. Leave it to the analyzed version to raise
+        # once it runs.
+        del code.instructions[start:]
+    if form is not None:
+      code.emit(ANALYZED, analyze(ast, env))
+      return
+
+  compile_ast(head, env, code)
+  for arg in rawargs:
+    compile_ast(arg, env, code)
+  code.emit(TAILCALL if tail else CALL, (len(rawargs), ast))
+
+def compile_body(body, env):
+  """Compile a lambda body into a Code that returns its last value."""
+  code = Code()
+  if not body:
+    code.emit(CONST, nil)
+  for ast in body[:-1]:
+    compile_ast(ast, env, code)
+    code.emit(POP)
+  if body:
+    compile_ast(body[-1], env, code, tail=True)
+  code.emit(RETURN)
+  return code
+
+def compile_toplevel(ast, env):
+  code = Code()
+  compile_ast(ast, env, code)
+  code.emit(RETURN)
+  return code
+
+def run_code(code, scope):
+  """Run 'code' in 'scope', and return the value it returns.
+
+  Calls to lambdas compiled for the vm push a frame on 'frames' and
+  keep going in this loop, so the depth of the recursion in Scheme code
+  isn't limited by the Python stack.
+  """
+  context = scope.context
+  tracking = not context.fast
+  callstack = context.callstack
+  base = len(callstack)
+  table = context.root._table
+
+  stack = []
+  # Saved (instructions, pc, scope, call, memo) of each caller. 'call'
+  # is the ast of the call that started the frame, and 'pending' the one
+  # of a call to Python code in progress; stacktrace_from reads them.
+  # 'memo' is the (Memoized, key) to cache the callee's result under.
+  frames = []
+  call = None
+  pending = None
+
+  instructions = code.instructions
+  pc = 0
+  try:
+    while True:
+      opcode, argument = instructions[pc]
+      pc += 1
+
+      if opcode == LOAD_ARG:
+        stack.append(scope.values[argument])
+
+      elif opcode == LOAD_GLOBAL:
+        value = table.get(argument, unassigned)
+        if value is unassigned:
+          # Maybe something declared it in a scope in between.
+          value = scope[argument]
+        stack.append(value)
+
+      elif opcode == CONST:
+        stack.append(argument)
+
+      elif opcode == LOAD:
+        depth, slot, symbol = argument
+        owner = scope
+        for _ in range(depth):
+          owner = owner.parent
+        if slot is None:
+          value = owner[symbol]
+        else:
+          value = owner.values[slot]
+          if value is unassigned:
+            value = owner.parent[symbol]
+        stack.append(value)
+
+      elif opcode == CALL or opcode == TAILCALL:
+        argc, ast = argument
+        start = len(stack) - argc
+        args = stack[start:]
+        function = stack[start - 1]
+        del stack[start - 1:]
+
+        if (function is apply and len(args) == 2 and
+            isinstance(args[0], Function)):
+          # Make the call here instead of in the builtin, so recursion
+          # through 'apply' doesn't use the Python stack.
+          function = args[0]
+          args = list(args[1])
+
+        memo = None
+        if type(function) is Memoized:
+          inner = function.function
+          if isinstance(inner, Lambda) and isinstance(inner.code, Code):
+            key, value = function.lookup(args)
+            if value is not unassigned:
+              stack.append(value)
+              continue
+            # Run it in this loop like any other lambda, so memoized
+            # recursion doesn't use the Python stack either. RETURN
+            # puts the result in the cache.
+            memo = (function, key)
+            function = inner
+
+        if isinstance(function, Lambda) and isinstance(function.code, Code):
+          if opcode == TAILCALL and context.tailcalls and memo is None:
+            # Entries below 'base' belong to whoever called us.
+            if tracking and len(callstack) > base:
+              callstack[-1] = ast
+            elif tracking:
+              callstack.append(ast)
+          else:
+            frames.append((instructions, pc, scope, call, memo))
+            if tracking:
+              callstack.append(ast)
+          scope = function.bind(args)
+          instructions = function.code.instructions
+          pc = 0
+          call = ast
+          continue
+
+        # Builtins, lambdas compiled by another engine and forms that
+        # only turn up at runtime. The value of a TAILCALL to one of
+        # these falls through to the RETURN after it.
+        pending = ast
+        if tracking:
+          callstack.append(ast)
+        if type(function) is BuiltinFunction:
+          # Same as BuiltinFunction.__call__, but saves a Python frame.
+          value = function.function(*args)
+          if function.returns is not None:
+            value = function.returns(value)
+        elif isinstance(function, Function):
+          value = function(*args)
+        else:
+          value = toObject(function.call(scope, *ast[1:]))
+        if tracking:
+          callstack.pop()
+        pending = None
+        stack.append(value)
+
+      elif opcode == RETURN:
+        if not frames:
+          if tracking:
+            del callstack[base:]
+          return stack.pop()
+        if tracking:
+          callstack.pop()
+        # The return value stays on the stack for the caller.
+        instructions, pc, scope, call, memo = frames.pop()
+        if memo is not None:
+          memo[0].store(memo[1], stack[-1])
+
+      elif opcode == JUMP_IF_FALSE:
+        if not stack.pop():
+          pc = argument
+
+      elif opcode == JUMP:
+        pc = argument
+
+      elif opcode == POP:
+        stack.pop()
+
+      elif opcode == JUMP_IF_FALSE_OR_POP:
+        if stack[-1]:
+          stack.pop()
+        else:
+          pc = argument
+
+      elif opcode == JUMP_IF_TRUE_OR_POP:
+        if stack[-1]:
+          pc = argument
+        else:
+          stack.pop()
+
+      elif opcode == STORE:
+        depth, slot, symbol, define = argument
+        value = stack[-1]
+        if define:
+          if slot is None:
+            scope.declare(symbol, value)
+          else:
+            scope.values[slot] = value
+        elif depth is None:
+          if symbol in table:
+            table[symbol] = value
+            if symbol in context.cached:
+              context.version += 1
+          else:
+            scope[symbol] = value
+        else:
+          owner = scope
+          for _ in range(depth):
+            owner = owner.parent
+          if slot is None or owner.values[slot] is unassigned:
+            # Not defined in that scope yet, so it's further out.
+            (owner if slot is None else owner.parent)[symbol] = value
+          else:
+            owner.values[slot] = value
+
+      elif opcode == MAKE_CLOSURE:
+        argnames, body, vararg, bodycode, bodyenv = argument
+        stack.append(Lambda(argnames, body, scope, vararg=vararg,
+                            code=bodycode, environment=bodyenv))
+
+      elif opcode == GETATTR:
+        stack.append(stack.pop().getattr(argument))
+
+      elif opcode == ASSERT:
+        if not stack[-1]:
+          # Like analyze_assert, so the stacktrace says where it was.
+          if tracking and context.stacktrace is None:
+            context.stacktrace = tuple(callstack) + (argument,)
+          raise AssertionError(argument)
+
+      elif opcode == ANALYZED:
+        stack.append(argument(scope))
+
+      else:
+        raise ValueError('Unknown opcode: %r' % opcode)
+  except:
+    if tracking:
+      if context.stacktrace is None:
+        context.stacktrace = tuple(callstack)
+      del callstack[base:]
+    raise
 
 # Root scope, where we are going to fill with globals.
 root = Scope()
@@ -483,7 +2084,7 @@ root = Scope()
 root.declare(toObject('nil'), nil)
 root.declare(toObject('true'), true)
 root.declare(toObject('false'), false)
-root.declare(toObject('pi'), math.pi)
+root.declare(toObject('pi'), toObject(math.pi))
 
 @root.setform('define')
 def define(scope, name, *rest):
@@ -493,13 +2094,49 @@ def define(scope, name, *rest):
     return value
 
   elif isinstance(name, List):
-    arglist = name[1:]
+    arglist = located(List(name[1:]), name)
     name = name[0]
     return scope.declare(name, lambda_.call(scope, arglist, *rest))
 
   else:
     raise ValueError("I don't know how to 'define' " + str(name))
 
+@define.analyzer
+def analyze_define(env, tail, name, *rest):
+  if isinstance(name, Symbol):
+    valueproc, = (analyze(ast, env) for ast in rest)
+  elif isinstance(name, List):
+    arglist = located(List(name[1:]), name)
+    valueproc = analyze_lambda(env, False, arglist, *rest)
+    name = name[0]
+  else:
+    raise ValueError("I don't know how to 'define' " + str(name))
+
+  slot = env.slots.get(name) if env.parent is not None else None
+  if slot is not None:
+    def execute(scope):
+      value = scope.values[slot] = valueproc(scope)
+      return value
+  else:
+    def execute(scope):
+      return scope.declare(name, valueproc(scope))
+  return execute
+
+@define.compiler
+def compile_define(env, code, tail, name, *rest):
+  if isinstance(name, Symbol):
+    value, = rest
+    compile_ast(value, env, code)
+  elif isinstance(name, List):
+    arglist = located(List(name[1:]), name)
+    compile_lambda(env, code, False, arglist, *rest)
+    name = name[0]
+  else:
+    raise ValueError("I don't know how to 'define' " + str(name))
+
+  slot = env.slots.get(name) if env.parent is not None else None
+  code.emit(STORE, (0, slot, name, True))
+
 def isattr(x):
   return isinstance(x, List) and len(x) == 3 and x[0] == '__attribute__'
 
@@ -530,11 +2167,95 @@ def set_(scope, name, *rest):
   else:
     raise ValueError("I don't know how to 'set!' " + str(name))
 
+@set_.analyzer
+def analyze_set(env, tail, name, *rest):
+  if isinstance(name, Symbol):
+    valueproc, = (analyze(ast, env) for ast in rest)
+    address = env.resolve(name)
+    if address is None:
+      context = env.root.context
+      table = env.root._table
+      def execute(scope):
+        value = valueproc(scope)
+        if name in table:
+          table[name] = value
+          if name in context.cached:
+            context.version += 1
+        else:
+          scope[name] = value
+        return value
+    elif address[1] is None:
+      depth = address[0]
+      def execute(scope):
+        value = valueproc(scope)
+        for _ in range(depth):
+          scope = scope.parent
+        scope[name] = value
+        return value
+    else:
+      depth, slot = address
+      def execute(scope):
+        value = valueproc(scope)
+        for _ in range(depth):
+          scope = scope.parent
+        if scope.values[slot] is unassigned:
+          scope.parent[name] = value
+        else:
+          scope.values[slot] = value
+        return value
+
+  elif isattr(name):
+    _, rawowner, attribute = name
+    ownerproc = analyze(rawowner, env)
+    valueproc, = (analyze(ast, env) for ast in rest)
+    def execute(scope):
+      owner = ownerproc(scope)
+      return owner.setattr(attribute, valueproc(scope))
+
+  elif isinstance(name, List) and isattr(name[0]):
+    arglist = name[1:]
+    ownerproc = analyze(name[0][1], env)
+    attribute = name[0][2]
+    body = rest
+    bodyenv = env.child(arglist, body)
+    code = analyze_body(body, bodyenv)
+    def execute(scope):
+      owner = ownerproc(scope)
+      return owner.setattr(attribute, Lambda(arglist, body, scope, code=code,
+                                             environment=bodyenv))
+
+  else:
+    raise ValueError("I don't know how to 'set!' " + str(name))
+
+  return execute
+
+@set_.compiler
+def compile_set(env, code, tail, name, *rest):
+  if not isinstance(name, Symbol):
+    # Setting attributes and methods isn't worth instructions of its
+    # own.
+    code.emit(ANALYZED, analyze_set(env, tail, name, *rest))
+    return
+
+  value, = rest
+  compile_ast(value, env, code)
+  code.emit(STORE, (env.resolve(name) or (None, None)) + (name, False))
+
 @root.setform('__attribute__')
 def attribute_(scope, rawowner, attribute):
   owner = scope.eval(rawowner)
   return owner.getattr(attribute)
 
+@attribute_.analyzer
+def analyze_attribute(env, tail, rawowner, attribute):
+  ownerproc = analyze(rawowner, env)
+  return lambda scope: ownerproc(scope).getattr(attribute)
+
+@attribute_.compiler
+def compile_attribute(env, code, tail, rawowner, attribute):
+  compile_ast(rawowner, env, code)
+  code.emit(GETATTR, attribute)
+
 @root.setform('assert')
 def assert_(scope, condition):
   result = scope.eval(condition)
@@ -542,66 +2263,202 @@ def assert_(scope, condition):
     raise AssertionError(condition)
   return result
 
-@root.setfunc('=')
+@assert_.analyzer
+def analyze_assert(env, tail, condition):
+  conditionproc = analyze(condition, env)
+  def execute_assert(scope):
+    result = conditionproc(scope)
+    if not result:
+      # The assert isn't on the callstack, so its condition goes at the
+      # end of the stacktrace, to say where it failed. In fast mode,
+      # stacktrace_from finds it in this frame.
+      context = scope.context
+      if context.stacktrace is None:
+        context.stacktrace = tuple(context.callstack) + (condition,)
+      raise AssertionError(condition)
+    return result
+  return execute_assert
+
+@assert_.compiler
+def compile_assert(env, code, tail, condition):
+  compile_ast(condition, env, code)
+  code.emit(ASSERT, condition)
+
+@root.setfunc('=', returns=toBool)
 def equal(a, b):
   return a == b
 
-@root.setfunc('+')
+# The arithmetic builtins check for two arguments first, which is what
+# most calls have.
+
+@root.setfunc('+', returns=toNumber)
 def add(*args):
+  if len(args) == 2:
+    return args[0] + args[1]
+  elif not args:
+    return 0
   result = args[0]
   for arg in args[1:]:
     result += arg
   return result
 
-@root.setfunc('-')
+@root.setfunc('-', returns=toNumber)
 def subtract(a, b=None):
   return -a if b is None else a - b
 
-@root.setfunc('*')
+@root.setfunc('*', returns=toNumber)
 def multiply(*args):
+  if len(args) == 2:
+    return args[0] * args[1]
+  elif not args:
+    return 1
   result = args[0]
   for arg in args[1:]:
     result *= arg
   return result
 
-@root.setfunc('/')
+@root.setfunc('/', returns=toNumber)
 def divide(a, b):
-  return a / b
+  if isinstance(a, float) or isinstance(b, float):
+    return a / b
+  # Dividing exact numbers is exact: an integer if it divides evenly,
+  # otherwise a Rational.
+  if b and not a % b:
+    return a // b
+  return fractions.Fraction(a, b)
 
 @root.setform('__string__')
 def string_(scope, string):
   assert type(string) == Symbol
   return ['__string__', string]
 
+@string_.analyzer
+def analyze_string(env, tail, string):
+  assert type(string) == Symbol
+  value = toObject(['__string__', string])
+  return lambda scope: value
+
+@string_.compiler
+def compile_string(env, code, tail, string):
+  assert type(string) == Symbol
+  code.emit(CONST, toObject(['__string__', string]))
+
 @root.setform('cond')
 def cond(scope, *pairs):
   for condition, result in pairs:
     if condition == 'else' or scope.eval(condition):
-      return scope.eval(result)
+      return Tail(scope, result)
+
+@cond.analyzer
+def analyze_cond(env, tail, *pairs):
+  clauses = tuple(
+      (None if condition == 'else' else analyze(condition, env),
+       analyze(result, env, tail))
+      for condition, result in pairs)
+  def execute(scope):
+    for conditionproc, resultproc in clauses:
+      if conditionproc is None or conditionproc(scope):
+        return resultproc(scope)
+    return nil
+  return execute
+
+@cond.compiler
+def compile_cond(env, code, tail, *pairs):
+  pairs = [(condition, result) for condition, result in pairs]
+  ends = []
+  for condition, result in pairs:
+    if condition == 'else':
+      compile_ast(result, env, code, tail)
+      break
+    compile_ast(condition, env, code)
+    skip = code.emit(JUMP_IF_FALSE)
+    compile_ast(result, env, code, tail)
+    ends.append(code.emit(JUMP))
+    code.patch(skip, len(code.instructions))
+  else:
+    code.emit(CONST, nil)
+  for end in ends:
+    code.patch(end, len(code.instructions))
 
-@root.setfunc('<')
+@root.setfunc('<', returns=toBool)
 def lessthan(lhs, rhs):
   return lhs < rhs
 
 @root.setform('and')
 def and_(scope, *exprs):
-  last = True
-  for expr in exprs:
+  if not exprs:
+    return True
+  for expr in exprs[:-1]:
     last = scope.eval(expr)
     if not last:
       return last
-  return last
+  return Tail(scope, exprs[-1])
+
+@and_.analyzer
+def analyze_and(env, tail, *exprs):
+  if not exprs:
+    return lambda scope: true
+  procs = tuple(analyze(expr, env) for expr in exprs[:-1])
+  last = analyze(exprs[-1], env, tail)
+  def execute(scope):
+    for proc in procs:
+      value = proc(scope)
+      if not value:
+        return value
+    return last(scope)
+  return execute
+
+@and_.compiler
+def compile_and(env, code, tail, *exprs):
+  if not exprs:
+    code.emit(CONST, true)
+    return
+  ends = []
+  for expr in exprs[:-1]:
+    compile_ast(expr, env, code)
+    ends.append(code.emit(JUMP_IF_FALSE_OR_POP))
+  compile_ast(exprs[-1], env, code, tail)
+  for end in ends:
+    code.patch(end, len(code.instructions))
 
 @root.setform('or')
 def or_(scope, *exprs):
-  last = False
-  for expr in exprs:
+  if not exprs:
+    return False
+  for expr in exprs[:-1]:
     last = scope.eval(expr)
     if last:
       return last
-  return last
-
-@root.setfunc('not')
+  return Tail(scope, exprs[-1])
+
+@or_.analyzer
+def analyze_or(env, tail, *exprs):
+  if not exprs:
+    return lambda scope: false
+  procs = tuple(analyze(expr, env) for expr in exprs[:-1])
+  last = analyze(exprs[-1], env, tail)
+  def execute(scope):
+    for proc in procs:
+      value = proc(scope)
+      if value:
+        return value
+    return last(scope)
+  return execute
+
+@or_.compiler
+def compile_or(env, code, tail, *exprs):
+  if not exprs:
+    code.emit(CONST, false)
+    return
+  ends = []
+  for expr in exprs[:-1]:
+    compile_ast(expr, env, code)
+    ends.append(code.emit(JUMP_IF_TRUE_OR_POP))
+  compile_ast(exprs[-1], env, code, tail)
+  for end in ends:
+    code.patch(end, len(code.instructions))
+
+@root.setfunc('not', returns=toBool)
 def not_(x):
   return not x
 
@@ -611,9 +2468,28 @@ def print_(*args):
 
 @root.setform('if')
 def if_(scope, cond, ifblock, elseblock):
-  return scope.eval(ifblock if scope.eval(cond) else elseblock)
-
-@root.setfunc('Object')
+  return Tail(scope, ifblock if scope.eval(cond) else elseblock)
+
+@if_.analyzer
+def analyze_if(env, tail, cond, ifblock, elseblock):
+  condproc = analyze(cond, env)
+  ifproc = analyze(ifblock, env, tail)
+  elseproc = analyze(elseblock, env, tail)
+  def execute(scope):
+    return ifproc(scope) if condproc(scope) else elseproc(scope)
+  return execute
+
+@if_.compiler
+def compile_if(env, code, tail, cond, ifblock, elseblock):
+  compile_ast(cond, env, code)
+  skip = code.emit(JUMP_IF_FALSE)
+  compile_ast(ifblock, env, code, tail)
+  end = code.emit(JUMP)
+  code.patch(skip, len(code.instructions))
+  compile_ast(elseblock, env, code, tail)
+  code.patch(end, len(code.instructions))
+
+@root.setfunc('Object', returns=None)
 def Object_():
   return UserObject()
 
@@ -621,55 +2497,688 @@ def Object_():
 def quote(scope, x):
   return x
 
-@root.setfunc('list*')
+@quote.analyzer
+def analyze_quote(env, tail, x):
+  return lambda scope: x
+
+@quote.compiler
+def compile_quote(env, code, tail, x):
+  code.emit(CONST, x)
+
+@root.setfunc('list*', returns=None)
 def liststar(*args):
-  return args
+  return List(args)
+
+@root.setfunc('cons', returns=None)
+def cons(car, cdr):
+  return Pair(car, cdr)
+
+@root.setfunc('car', returns=None)
+def car(pair):
+  return pair.car
+
+@root.setfunc('cdr', returns=None)
+def cdr(pair):
+  return pair.cdr
+
+@root.setfunc('pair?', returns=toBool)
+def pairp(x):
+  return isinstance(x, Pair)
+
+@root.setfunc('null?', returns=toBool)
+def nullp(x):
+  # () in quoted code is an empty List.
+  return x is nil or isinstance(x, List) and not x
+
+# The list functions below loop instead of recursing, so they work on
+# lists of any length.
+
+@root.setfunc('length', returns=toNumber)
+def length(items):
+  count = 0
+  for _ in items:
+    count += 1
+  return count
+
+@root.setfunc('map', returns=None)
+def map_(function, *lists):
+  if len(lists) == 1:
+    return make_list([function(item) for item in lists[0]])
+  return make_list([function(*items) for items in zip(*lists)])
+
+@root.setfunc('append', returns=None)
+def append(*lists):
+  if not lists:
+    return nil
+  items = []
+  for items_ in lists[:-1]:
+    items.extend(items_)
+  return make_list(items, lists[-1])
+
+@root.setfunc('reverse', returns=None)
+def reverse(items):
+  result = nil
+  for item in items:
+    result = Pair(item, result)
+  return result
 
-@root.setfunc('remainder')
+@root.setfunc('remainder', returns=toNumber)
 def remainder(x, n):
   return x % n
 
+def split_arglist(arglist):
+  """Split the arglist of a lambda into its argument names and the name
+  of its rest argument, or None if it has none.
+
+  (a b . c) gives ([a, b], c).
+  """
+  if (not isinstance(arglist, list) or
+      not all(isinstance(arg, Symbol) for arg in arglist)):
+    raise ValueError('Argument list has to be a list of names, not ' +
+                     repr(arglist))
+  if '.' not in arglist:
+    return arglist, None
+  if arglist.index('.') != len(arglist) - 2 or arglist[-1] == '.':
+    raise ValueError("'.' has to come right before the last argument in " +
+                     repr(List(arglist)))
+  return located(List(arglist[:-2]), arglist), arglist[-1]
+
 @root.setform('lambda')
 def lambda_(scope, arglist, *body):
-  if '.' in arglist:
-    # TODO: Error handling.
-    vararg = arglist[-1]
-    argnames = arglist[:-2]
-  else:
-    vararg = None
-    argnames = arglist
+  argnames, vararg = split_arglist(arglist)
   return Lambda(argnames, body, scope,
                 vararg=vararg)
 
-@root.setfunc('apply')
+@lambda_.analyzer
+def analyze_lambda(env, tail, arglist, *body):
+  argnames, vararg = split_arglist(arglist)
+  bodyenv = env.child(list(argnames) + ([vararg] if vararg else []), body)
+  code = analyze_body(body, bodyenv)
+  def execute(scope):
+    return Lambda(argnames, body, scope, vararg=vararg, code=code,
+                  environment=bodyenv)
+  return execute
+
+@lambda_.compiler
+def compile_lambda(env, code, tail, arglist, *body):
+  argnames, vararg = split_arglist(arglist)
+  bodyenv = env.child(list(argnames) + ([vararg] if vararg else []), body)
+  code.emit(MAKE_CLOSURE, (argnames, body, vararg,
+                           compile_body(body, bodyenv), bodyenv))
+
+@root.setfunc('apply', returns=None)
 def apply(f, args):
   return f(*args)
 
-@root.setfunc('gcd')
-def gcd_(first, *rest):
-  g = first
-  for item in rest:
-    g = fractions.gcd(item, g)
-  return g
+# Results 'memoize' keeps by default.
+MEMO_MAXSIZE = 1024
+
+@root.setfunc('memoize', returns=None)
+def memoize(function, maxsize=MEMO_MAXSIZE):
+  return Memoized(function, maxsize)
+
+def memo_definition(name, body):
+  """Turn (define-memo (name args...) body...) into the 'define' it means.
+
+  That is (define name (memoize (lambda (args...) body...))), which is
+  returned as the arguments to 'define'.
+  """
+  if not isinstance(name, List) or not name:
+    raise ValueError("I don't know how to 'define-memo' " + str(name))
+  arglist = located(List(name[1:]), name)
+  function = List([Symbol('lambda'), arglist] + list(body))
+  value = List([Symbol('memoize'), located(function, name)])
+  # Calls show up in stacktraces, so they need a location.
+  return name[0], located(value, name)
+
+@root.setform('define-memo')
+def define_memo(scope, name, *body):
+  return define.form(scope, *memo_definition(name, body))
+
+@define_memo.analyzer
+def analyze_define_memo(env, tail, name, *body):
+  return analyze_define(env, tail, *memo_definition(name, body))
+
+@define_memo.compiler
+def compile_define_memo(env, code, tail, name, *body):
+  compile_define(env, code, tail, *memo_definition(name, body))
+
+@root.setfunc('gcd', returns=toNumber)
+def gcd_(*args):
+  if any(isinstance(arg, float) for arg in args):
+    # Whole floats count as the integer they are, and make the result a
+    # float, as in Scheme. math.gcd refuses floats and Python 2's
+    # fractions.gcd doesn't, so they are converted here for both.
+    if not all(float(arg).is_integer() for arg in args):
+      raise ValueError('gcd needs integers, not %s' %
+                       ' '.join(map(repr, args)))
+    return float(gcd_(*[int(arg) for arg in args]))
+  if len(args) == 2:
+    return abs(gcd(args[0], args[1]))
+  g = 0
+  for arg in args:
+    g = gcd(g, arg)
+  return abs(g)
+
+# Vectors. The builtins below look up the function they are given in
+# BULK_MAPS and BULK_REDUCES, and if it is there, work on the whole
+# array at once in C instead of calling the function for each element.
+# Keys are (function, number of vectors). Functions from the standard
+# library are added by 'bootstrap'.
+BULK_MAPS = {
+    (add, 2): lambda a, b: map(operator.add, a, b),
+    (subtract, 1): lambda a: map(operator.neg, a),
+    (subtract, 2): lambda a, b: map(operator.sub, a, b),
+    (multiply, 2): lambda a, b: map(operator.mul, a, b),
+}
+BULK_REDUCES = {
+    add: sum,
+    multiply: lambda items, initial: functools.reduce(operator.mul, items,
+                                                      initial),
+}
+STDLIB_BULK_MAPS = {
+    'square': lambda a: map(operator.mul, a, a),
+    'cube': lambda a: map(operator.mul, map(operator.mul, a, a), a),
+    'abs': lambda a: map(abs, a),
+}
+
+@root.setfunc('vector', returns=None)
+def vector(*items):
+  return make_vector(items)
+
+@root.setfunc('vector-range', returns=None)
+def vector_range(*args):
+  return make_vector(range(*args), 'l')
+
+@root.setfunc('vector-length', returns=toNumber)
+def vector_length(v):
+  return len(v.items)
+
+@root.setfunc('vector-ref', returns=toNumber)
+def vector_ref(v, index):
+  return v.items[index]
+
+@root.setfunc('list->vector', returns=None)
+def list_to_vector(items):
+  return make_vector(items)
+
+@root.setfunc('vector->list', returns=None)
+def vector_to_list(v):
+  return make_list(list(v))
+
+@root.setfunc('vector-map', returns=None)
+def vector_map(function, *vectors):
+  arrays = [v.items for v in vectors]
+  bulk = BULK_MAPS.get((function, len(arrays)))
+  if bulk is not None:
+    # Python 2's map pads short arrays with None where Python 3's stops
+    # at the shortest, so cut them to the same length, like zip below.
+    length = min(map(len, arrays))
+    arrays = [a[:length] if len(a) > length else a for a in arrays]
+    # Integers stay integers, as long as nothing is a float. Vectors
+    # in a list can hold either, so make_vector works that out.
+    typecodes = set(getattr(a, 'typecode', None) for a in arrays)
+    typecode = ('d' if 'd' in typecodes else
+                'l' if typecodes == set('l') else None)
+    return make_vector(bulk(*arrays), typecode)
+  return make_vector(function(*map(toNumber, items))
+                     for items in zip(*arrays))
+
+@root.setfunc('vector-sum', returns=toNumber)
+def vector_sum(v):
+  return sum(v.items)
+
+@root.setfunc('vector-reduce', returns=None)
+def vector_reduce(function, initial, v):
+  """Combine the elements of 'v' like 'accumulate' from SICP 2.2.3.
+
+  That is, (function v0 (function v1 ... (function vn initial))).
+  """
+  bulk = BULK_REDUCES.get(function)
+  if bulk is not None:
+    return toNumber(bulk(v.items, initial))
+  result = initial
+  for item in reversed(v.items):
+    result = function(toNumber(item), result)
+  return result
+
+# Builtins without side effects, which calls with constant arguments
+# can be worked out for ahead of time.
+PURE_BUILTINS = {
+    '+': add, '-': subtract, '*': multiply, '/': divide, '=': equal,
+    '<': lessthan, 'remainder': remainder, 'gcd': gcd_, 'not': not_,
+}
+
+def located(ast, like):
+  """Give 'ast' the location of 'like', so errors can point at it."""
+  ast.start, ast.end, ast.parse_result = like.start, like.end, like.parse_result
+  return ast
+
+def bound_names(ast):
+  """Names 'ast' binds anywhere, with define, define-memo and set!, or
+  as arguments of a lambda.
+
+  Errs on the side of too many names: anything in the target of one of
+  those forms counts.
+  """
+  names = set()
+  stack = [ast]
+  while stack:
+    ast = stack.pop()
+    if not isinstance(ast, List) or not ast or ast[0] == 'quote':
+      continue
+    if ast[0] in ('define', 'define-memo', 'set!', 'lambda') and len(ast) > 1:
+      target = ast[1]
+      if isinstance(target, Symbol):
+        names.add(target)
+      elif isinstance(target, List):
+        names.update(name for name in target if isinstance(name, Symbol))
+    stack.extend(ast)
+  return names
+
+def fold_constants(forms, scope=None):
+  """Yield 'forms' one at a time, with the parts that are constant
+  worked out.
+
+  'forms' is a whole script, like a ParseResult or what parse_path
+  yields, to run in 'scope'. All of it is read before the first form
+  comes out, so nothing happens until the caller asks for one, and
+  errors parsing it come from there, as they would without folding.
+  Calls to PURE_BUILTINS with constant arguments become their value,
+  and 'if' and 'cond' lose the branches that constant conditions rule
+  out. Constants are numbers, quotes, true, false and nil.
+
+  This relies on those names meaning what they do in the globals now,
+  so names that the script binds anywhere are left alone. Asserts are
+  left as they are, so their messages still show the original
+  condition. Calls that raise are left for the error to happen when
+  they run.
+  """
+  forms = list(forms)
+  bootstrap(scope)
+  table = (root if scope is None else scope).root._table
+  rebound = set()
+  for ast in forms:
+    rebound.update(bound_names(ast))
+  # What each name we rely on has to be bound to.
+  expected = dict(PURE_BUILTINS, true=true, false=false, nil=nil,
+                  quote=quote, cond=cond)
+  expected['if'] = if_
+  known = dict((name, value) for name, value in expected.items()
+               if name not in rebound and table.get(name) is value)
+
+  def constant(ast):
+    """The value of 'ast' if it is a constant, or 'unassigned'."""
+    if isinstance(ast, Number):
+      return ast
+    elif isinstance(ast, Symbol) and ast in ('true', 'false', 'nil'):
+      return known.get(ast, unassigned)
+    elif (isinstance(ast, List) and len(ast) == 2 and ast[0] == 'quote' and
+          'quote' in known):
+      return ast[1]
+    return unassigned
+
+  def constant_ast(value, like):
+    """An ast for 'value' in place of 'like', or None if there is none."""
+    if isinstance(value, Number):
+      return located(type(value)(value), like)
+    elif 'quote' in known:
+      return located(List([Symbol('quote'), value]), like)
+    return None
+
+  def fold(ast):
+    if not isinstance(ast, List) or not ast:
+      return ast
+    head = ast[0]
+    if head in ('quote', '__string__', 'assert'):
+      return ast
+    ast = located(List(map(fold, ast)), ast)
+    if not isinstance(head, Symbol) or head not in known:
+      return ast
 
-# Load the standard library.
-with open(PATH_TO_STDLIB) as f:
-  root(parse(f.read(), PATH_TO_STDLIB))
+    if head == 'if' and len(ast) == 4:
+      condition = constant(ast[1])
+      if condition is not unassigned:
+        return ast[2] if condition else ast[3]
+
+    elif head == 'cond' and all(isinstance(clause, List) and len(clause) == 2
+                                for clause in ast[1:]):
+      clauses = []
+      for clause in ast[1:]:
+        condition = clause[0]
+        if condition == 'else':
+          clauses.append(clause)
+          break
+        value = constant(condition)
+        if value is unassigned:
+          clauses.append(clause)
+        elif value:
+          clauses.append(located(List([Symbol('else'), clause[1]]), clause))
+          break
+      if clauses and clauses[0][0] == 'else':
+        return clauses[0][1]
+      return located(List([head] + clauses), ast)
+
+    elif isinstance(known[head], BuiltinFunction):
+      args = [constant(arg) for arg in ast[1:]]
+      if not any(arg is unassigned for arg in args):
+        try:
+          value = known[head](*args)
+        except Exception:
+          return ast
+        return constant_ast(value, ast) or ast
+
+    return ast
+
+  for ast in forms:
+    yield fold(ast)
+
+def bootstrap(scope=None):
+  """Load the standard library into the interpreter of 'scope', once.
+
+  Scopes do this themselves before they run anything, so that only
+  running code pays for it, and the options on the context (like
+  'engine' and 'fast') apply to the standard library too. Call this to
+  get at the standard library before that.
+  """
+  context = (root if scope is None else scope).context
+  if context.bootstrapped:
+    return
+  context.bootstrapped = True
+  if context.stdlib is not None:
+    context.root.run_stream(parse_path(context.stdlib))
+  context.snapshot = dict(context.root._table)
+  for name, bulk in STDLIB_BULK_MAPS.items():
+    function = context.snapshot.get(name)
+    if isinstance(function, Function):
+      BULK_MAPS[function, 1] = bulk
+
+def reset(scope=None):
+  """Put the globals of the interpreter of 'scope' back to the snapshot.
+
+  Everything defined since the standard library was loaded is
+  forgotten, without running the standard library again.
+  """
+  context = (root if scope is None else scope).context
+  bootstrap(context.root)
+  # Analyzed code holds on to this dict, so it has to stay the same one.
+  table = context.root._table
+  table.clear()
+  table.update(context.snapshot)
+  context.version += 1
+
+# Globals that code sent to 'parallel-map' workers can't use, because
+# their effects would happen in the worker, where nobody sees them.
+IMPURE_NAMES = frozenset(['set!', 'print'])
+
+def definition_of(name, function):
+  """The top level form that defined 'function' as 'name', or None.
+
+  It is the last 'define' or 'define-memo' of 'name' before the body of
+  'function', in the ParseResult the body came from.
+  """
+  body = [ast for ast in function.body if ast.parse_result is not None]
+  if not body:
+    return None
+  found = None
+  for form in body[0].parse_result:
+    if form.start > body[0].start:
+      break
+    if (isinstance(form, List) and len(form) > 2 and
+        form[0] in ('define', 'define-memo') and
+        (form[1] == name or isinstance(form[1], List) and form[1] and
+         form[1][0] == name)):
+      found = form
+  return found
+
+def parallel_definitions(name, context):
+  """What a 'parallel-map' worker has to run to call the global 'name'.
+
+  Those are the top level definitions of 'name' and of every global it
+  uses that isn't what it was after bootstrapping, and so on. Each is
+  returned as dump_ast data, with what it takes to rebuild its
+  ParseResult, so errors in the worker still point at the source.
+
+  Only top level lambdas and numbers can be sent. Code that uses
+  IMPURE_NAMES isn't sent either, as the worker would swallow the
+  effect.
+  """
+  table = context.root._table
+  definitions = []
+  seen = set()
+  pending = [name]
+  while pending:
+    name = pending.pop()
+    if name in seen or name not in table:
+      continue
+    seen.add(name)
+    value = table[name]
+    if context.snapshot.get(name) is value:
+      continue # The worker has the same one.
+
+    if isinstance(value, Number) and type(value) in CACHE_TAGS:
+      form = List([Symbol('define'), Symbol(name), value])
+      definitions.append((dump_ast(form), '', None, 0, 1))
+      continue
+
+    function = value.function if isinstance(value, Memoized) else value
+    form = None
+    if isinstance(function, Lambda) and function.parentscope is context.root:
+      form = definition_of(name, function)
+    if form is None:
+      raise ValueError("parallel-map can only send top level definitions "
+                       "of functions and numbers to its workers, which %s "
+                       "isn't" % name)
+
+    local = bound_names(form)
+    stack = [form]
+    while stack:
+      ast = stack.pop()
+      if isinstance(ast, Symbol) and ast not in local:
+        if ast in IMPURE_NAMES:
+          raise ValueError('parallel-map needs a function without side '
+                           'effects, but %s uses %s' % (name, ast))
+        pending.append(ast)
+      elif isinstance(ast, List) and ast and ast[0] != 'quote':
+        stack.extend(ast)
+
+    parse_result = form.parse_result
+    definitions.append((dump_ast(form), parse_result.source,
+                        parse_result.filename, parse_result.offset,
+                        parse_result.lineno))
+  return definitions
+
+def parallel_init(definitions, engine, fast):
+  """Get a 'parallel-map' worker's globals ready, see parallel_definitions.
+
+  Runs in each worker as it starts. Forked workers already have all of
+  the parent's globals; 'reset' makes them the same as started ones.
+  """
+  root.context.engine = engine
+  root.context.fast = fast
+  reset()
+  for data, source, filename, offset, lineno in definitions:
+    parse_result = ParseResult([], source, filename, offset, lineno)
+    root.run(load_ast(data, parse_result))
+
+def parallel_call(name, item):
+  """Call the global 'name' on 'item' in a 'parallel-map' worker."""
+  return root[Symbol(name)](item)
+
+@root.setfunc('parallel-map', returns=None)
+def parallel_map(function, items, chunksize=nil):
+  """Like 'map' with one list, with the calls spread over a process pool.
+
+  'function' has to be a global defined at the top level, since that is
+  what the workers can define too, see parallel_definitions. Each
+  worker gets 'chunksize' items at a time; by default the items are cut
+  into about four chunks per worker. Results come back in order.
+  """
+  # Only needed by the few scripts that use this, and slow to import.
+  import multiprocessing
+  items = list(items)
+  lambda_ = function.function if isinstance(function, Memoized) else function
+  # Builtins are quick enough as they are, and workers can't start
+  # workers of their own.
+  if (len(items) < 2 or not isinstance(lambda_, Lambda) or
+      multiprocessing.current_process().daemon):
+    return make_list([function(item) for item in items])
+
+  context = lambda_.parentscope.context
+  name = None
+  for key, value in context.root._table.items():
+    if value is function:
+      name = key
+  if name is None:
+    raise ValueError('parallel-map needs a function that is defined as a '
+                     'global, so its workers can define it too')
+  definitions = parallel_definitions(name, context)
+
+  pool = multiprocessing.Pool(initializer=parallel_init,
+                              initargs=(definitions, context.engine,
+                                        context.fast))
+  try:
+    results = pool.map(functools.partial(parallel_call, str(name)), items,
+                       None if chunksize is nil else chunksize)
+  finally:
+    pool.terminate()
+    pool.join()
+  return make_list(results)
+
+def run_script(job):
+  """Run one script for 'run_scripts', in a worker.
+
+  Returns what the script printed, and what run_stream would print
+  about the failure if it failed, or None.
+  """
+  path, engine, fast, debug, cache, optimize = job
+  try:
+    from StringIO import StringIO
+  except ImportError: # Python 3
+    from io import StringIO
+  root.context.engine = engine
+  root.context.fast = fast
+  stdout = sys.stdout
+  sys.stdout = output = StringIO()
+  failure = None
+  try:
+    forms = parse_path(path, cache=cache)
+    if optimize:
+      forms = fold_constants(forms)
+    for ast in forms:
+      root.run(ast)
+  except Exception as e:
+    failure = root.failure(e, sys.exc_info()[2])
+    if debug:
+      import traceback
+      failure = traceback.format_exc() + failure
+  finally:
+    sys.stdout = stdout
+  return output.getvalue(), failure
+
+def run_scripts(paths, jobs=None, cache=True, optimize=False):
+  """Run each of the scripts at 'paths', 'jobs' at a time.
+
+  Each script runs in a process of its own, forked from this one after
+  the standard library is loaded, so none of them loads it again and
+  none of them sees what the others define. Where processes can't be
+  forked, they start from scratch, and take the settings on 'root' with
+  them. What each script prints comes out in order, once it is done,
+  followed by where each of the scripts that failed went wrong.
+  Returns how many failed.
+  """
+  # Only needed when running more than one script, and slow to import.
+  import multiprocessing
+  bootstrap()
+  context = root.context
+  jobs_ = [(path, context.engine, context.fast, context.debug, cache,
+            optimize) for path in paths]
+  failures = []
+  # A new worker for each script, so they all start from here.
+  pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+  try:
+    for path, (output, failure) in zip(paths, pool.imap(run_script, jobs_)):
+      sys.stdout.write(output)
+      sys.stdout.flush()
+      if failure is not None:
+        failures.append((path, failure))
+  finally:
+    pool.terminate()
+    pool.join()
+
+  for path, failure in failures:
+    print('*** %s failed:' % path)
+    print(failure)
+  if failures:
+    print('%d of %d scripts failed' % (len(failures), len(paths)))
+  return len(failures)
+
+# The standard library is loaded by 'bootstrap', when it's needed.
+root.context.stdlib = PATH_TO_STDLIB
 
 def main():
-  # TODO: Real option parsing.
-  if len(sys.argv) != 2 and (len(sys.argv) != 3 or sys.argv[2] != '--debug'):
-    print('Usage: python %s script.scm [--debug]' % sys.argv[0])
-    return 1
-
-  if len(sys.argv) == 3 and sys.argv[2] == '--debug':
+  # Only needed when run as a script, and slow to import.
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('scripts', metavar='script', nargs='+',
+                      help='with more than one, the scripts run in '
+                           'parallel, each in a process of its own')
+  parser.add_argument('--jobs', type=int,
+                      help='how many scripts to run at once; defaults to '
+                           'the number of cores')
+  parser.add_argument('--debug', action='store_true',
+                      help='dump the Python stacktrace on error')
+  parser.add_argument('--no-cache', action='store_true',
+                      help="don't read or write the script's parse cache")
+  parser.add_argument('--fast', action='store_true',
+                      help="don't keep track of the callstack while running")
+  parser.add_argument('--optimize', action='store_true',
+                      help='work out constant expressions before running; '
+                           'reads the whole script first')
+  parser.add_argument('--engine', choices=ENGINES, default='closure',
+                      help="'tree' walks the ast on every evaluation "
+                           "instead of compiling it to closures first, "
+                           "'vm' compiles it to instructions for a stack "
+                           "machine, which isn't limited by the Python "
+                           "stack")
+  parser.add_argument('--profile', metavar='FILE',
+                      help='report where the time went on stderr, and '
+                           'write the sampled stacks to FILE in the '
+                           'collapsed format flame graph tools read')
+  options = parser.parse_args()
+
+  if options.debug:
     print('*** Running in debug mode ***')
-    root.debug = True
-
-  with open(sys.argv[1]) as f:
-    content = f.read()
-
-  root(parse(content, sys.argv[1]))
+    root.context.debug = True
+
+  if options.profile and options.fast:
+    parser.error("--profile needs the callstack, which --fast doesn't keep")
+  if options.profile and len(options.scripts) > 1:
+    parser.error('--profile only works with one script')
+
+  root.context.engine = options.engine
+  root.context.fast = options.fast
+
+  if len(options.scripts) > 1:
+    return 1 if run_scripts(options.scripts, options.jobs,
+                            cache=not options.no_cache,
+                            optimize=options.optimize) else 0
+
+  forms = parse_path(options.scripts[0], cache=not options.no_cache)
+  if options.optimize:
+    forms = fold_constants(forms)
+  if not options.profile:
+    root.run_stream(forms)
+    return
+
+  profiler = Profiler(root.context)
+  profiler.start()
+  try:
+    root.run_stream(forms)
+  finally:
+    profiler.stop()
+    profiler.report(sys.stderr)
+    profiler.write_collapsed(options.profile)
 
 if __name__ == '__main__':
   exit(main() or 0)
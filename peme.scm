@@ -0,0 +1,136 @@
+;;; Things only peme.py does
+
+; python peme.py peme.scm
+; The SICP scripts run with scheme.py too, so they stick to what it can
+; do. Checks of what peme.py adds go here.
+
+;;; Tail calls
+
+; With tail calls, an iterative process runs in constant space, so a
+; long loop doesn't hit the recursion limit.
+define (count-down n)
+  if (= n 0)
+     0
+     count-down (- n 1)
+
+assert (= 0 (count-down 5000))
+
+; A recursive process still needs the Python stack: each term of 'sum'
+; waits on the rest of the sum, which tail calls don't help with.
+; (pi-sum 1 1000) needs about 250 levels of that, more than there is
+; room for on some engines, so this stops at 500.
+define (sum term a next b)
+  if (> a b)
+     0
+     + (term a)
+       (sum term (next a) next b)
+
+define (pi-sum a b)
+  define (pi-term x) (/ 1.0 (* x (+ x 2)))
+  define (pi-next x) (+ x 4)
+  sum pi-term a pi-next b
+
+assert
+  > 0.01
+    abs
+      - pi
+        (* 8 (pi-sum 1 500))
+
+;;; Numbers
+
+; The builtin numbers are exact, like 2.1's rationals. Dividing
+; integers gives an integer if it divides evenly, and a rational number
+; otherwise. Integers don't overflow.
+
+assert (= (/ 1 2) (/ 2 4))
+assert (= 3 (/ 6 2))
+assert (= 1 (+ (/ 1 3) (/ 2 3)))
+assert (= 0.5 (/ 1.0 2))
+assert (= 6 (gcd -12 18))
+assert (= 2.0 (gcd 2.0 4))
+assert
+  = 1000000000000000000000000000
+    * 1000000000 1000000000 1000000000
+
+;;; Memoization
+
+; The tree recursion of 1.2's nCr computes the same elements over and
+; over. With 'define-memo' each one is only computed once, so this is
+; fast.
+define-memo (nCr-memo n r)
+  if (or (= n r) (= 0 r))
+     1
+     + (nCr-memo (- n 1) r)
+       nCr-memo (- n 1) (- r 1)
+
+assert (= 155117520 (nCr-memo 30 15))
+assert (= 255 nCr-memo.misses)
+assert (= 196 nCr-memo.hits)
+assert (= 155117520 (nCr-memo 30 15))
+assert (= 197 nCr-memo.hits)
+
+; The cache is bounded, and keeps the most recently used results.
+define memo-square (memoize square 2)
+memo-square 1
+memo-square 2
+memo-square 1
+memo-square 3
+assert (= 2 memo-square.currsize)
+memo-square 1
+assert (= 2 memo-square.hits)
+set! memo-square.maxsize 1
+assert (= 1 memo-square.currsize)
+
+;;; Processes
+
+; Lots of independent searches, with 1.2's smallest-divisor, spread over
+; a pool of processes.
+define (smallest-divisor n)
+  find-divisor n 2
+
+define (find-divisor n test-divisor)
+  cond ((> (square test-divisor) n) n)
+       ((= 0 (remainder n test-divisor)) test-divisor)
+       (else (find-divisor n (+ test-divisor 1)))
+
+define divisors (parallel-map smallest-divisor (list* 199 1999 19999))
+assert (= 199 (car divisors))
+assert (= 1999 (car (cdr divisors)))
+assert (= 7 (car (cdr (cdr divisors))))
+
+;;; Vectors
+
+; 1.3's sums, over vectors. Builtins like 'cube' and '+' run over the
+; whole vector at once, lambdas once for each element.
+
+assert
+  = 3025
+    vector-sum (vector-map cube (vector-range 1 11))
+
+assert
+  > 0.01
+    abs
+      - pi
+        * 8
+          vector-sum
+            vector-map (lambda (x) (/ 1.0 (* x (+ x 2))))
+                       (vector-range 1 1001 4)
+
+assert
+  = 3628800
+    vector-reduce * 1 (vector-range 1 11)
+
+; Numbers that don't fit in the array stay exact.
+assert
+  = 48000000024000000005
+    vector-sum (vector-map square (vector-range 4000000000 4000000003))
+
+; So do rationals.
+assert
+  = 1
+    vector-sum (vector (/ 1 3) (/ 2 3))
+
+; Mapping over vectors of different lengths stops at the shortest.
+assert
+  = 33
+    vector-sum (vector-map + (vector 1 2 3) (vector 10 20))
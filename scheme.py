@@ -15,6 +15,7 @@ structure of this file:
   parse functions
     legacyparse
     parse function
+    parse cache
 
   Scheme runtime
     Scheme class
@@ -23,10 +24,15 @@ structure of this file:
 # TODO: Break this file up into multiple files in a nice way.
 
 import fractions
+import hashlib
+import marshal
 import math
+import mmap
+import os
 import random
 import re
 import sys
+import tempfile
 
 INT_RE = re.compile(r'(?:\+|\-|)\d+')
 FLOAT_RE = re.compile(r'(?:\+|\-|)(?:\.\d+|\d+\.\d*)')
@@ -37,9 +43,13 @@ EMPTY_LINE_RE = re.compile(r'\A\s*\n|\s*?(?=\n|\Z)', re.MULTILINE)
 CONSECUTIVE_LINE_RE = re.compile(r'\n+', re.MULTILINE)
 SPACES_RE = re.compile(r'\s*', re.MULTILINE)
 
-PATH_TO_STDLIB = './stdlib.scm'
+PATH_TO_STDLIB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'stdlib.scm')
 
 class Ast(object):
+  # Subclasses without __slots__ of their own get a __dict__ as usual.
+  __slots__ = ()
+
   def __new__(cls, *args, **kwargs):
     self = super(Ast, cls).__new__(cls, *args, **kwargs)
     self.attributes = dict()
@@ -49,8 +59,45 @@ class Nil(Ast):
   def __repr__(self):
     return 'nil'
 
+  def __iter__(self):
+    return iter(())
+
 nil = Nil()
 
+class Pair(Ast):
+  """A cons cell. A chain of these ending in nil is a list."""
+
+  __slots__ = ('attributes', 'car', 'cdr')
+
+  def __init__(self, car, cdr):
+    self.car = car
+    self.cdr = cdr
+
+  def __iter__(self):
+    pair = self
+    while isinstance(pair, Pair):
+      yield pair.car
+      pair = pair.cdr
+    if pair is not nil:
+      raise TypeError('Not a list: %r' % self)
+
+  def __repr__(self):
+    # Iterative, so that long lists don't hit the recursion limit.
+    items = []
+    pair = self
+    while isinstance(pair, Pair):
+      items.append(repr(pair.car))
+      pair = pair.cdr
+    if pair is not nil:
+      items += ['.', repr(pair)]
+    return '(%s)' % ' '.join(items)
+
+def make_list(items, tail=nil):
+  """Build a list of Pairs out of a Python sequence, ending in 'tail'."""
+  for item in reversed(items):
+    tail = Pair(item, tail)
+  return tail
+
 class List(Ast, list):
   def __repr__(self):
     return '(%s)' % ' '.join(map(repr, self))
@@ -370,13 +417,125 @@ assert (
           ['+', 'a',
                 'b']])])
 
+# Parsed files are cached in a __scmcache__ directory next to them, so
+# running the same file again doesn't have to parse it. Bump this when
+# the Ast or the format of the cache changes.
+CACHE_VERSION = 2
+CACHE_MAGIC = b'SCMC'
+
+# Ast types in the cache. Lists are tag 0.
+CACHE_TYPES = (List, Symbol, Int, Float)
+CACHE_TAGS = dict((cls, tag) for tag, cls in enumerate(CACHE_TYPES))
+CACHE_VALUES = (tuple, str, int, float)
+
+def cache_path(path):
+  """Where the cache for the file at 'path' goes."""
+  directory, name = os.path.split(path)
+  return os.path.join(directory, '__scmcache__', '%s.scheme-py%d%d.scmc' %
+                      ((name,) + tuple(sys.version_info[:2])))
+
+def cache_key(source):
+  """Digest that a cache has to match to be used for 'source'."""
+  key = hashlib.sha1(('%d %s\n' % (CACHE_VERSION, sys.version)).encode())
+  key.update(source if isinstance(source, bytes) else source.encode('utf-8'))
+  return key.digest()
+
+def dump_ast(ast):
+  """'ast' as a flat tuple of nodes that marshal can write.
+
+  Each node is (tag, value, start, end), in prefix order. The value of a
+  list is how many children follow it. Being flat, deeply nested asts
+  need neither deep recursion here nor in marshal.
+  """
+  nodes = []
+  stack = [ast]
+  while stack:
+    ast = stack.pop()
+    tag = CACHE_TAGS[type(ast)]
+    if tag == 0:
+      value = len(ast)
+      stack.extend(reversed(ast))
+    else:
+      value = CACHE_VALUES[tag](ast)
+    nodes.append((tag, value, getattr(ast, 'start', None),
+                  getattr(ast, 'end', None)))
+  return tuple(nodes)
+
+def load_ast(nodes):
+  """Rebuild an Ast from what dump_ast returned."""
+  root = None
+  parents = [] # [list, number of its children still to come]
+  for tag, value, start, end in nodes:
+    ast = List() if tag == 0 else CACHE_TYPES[tag](value)
+    if start is not None:
+      ast.start = start
+    if end is not None:
+      ast.end = end
+
+    if parents:
+      parent = parents[-1]
+      parent[0].append(ast)
+      parent[1] -= 1
+      if not parent[1]:
+        parents.pop()
+    else:
+      root = ast
+    if tag == 0 and value:
+      parents.append([ast, value])
+  return root
+
+def parse_path(path):
+  """'parse' the file at 'path', using its cache if it is up to date.
+
+  Otherwise the cache gets written after parsing. Problems with the
+  cache are ignored; it is only there to make things faster.
+  """
+  with open(path) as f:
+    source = f.read()
+  key = cache_key(source)
+  header = len(CACHE_MAGIC) + len(key)
+
+  try:
+    with open(cache_path(path), 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if data[:header] == CACHE_MAGIC + key:
+        return [load_ast(form) for form in marshal.loads(data[header:])]
+    finally:
+      data.close()
+  except (EnvironmentError, EOFError, ValueError, TypeError):
+    pass
+
+  code = parse(source)
+  filename = cache_path(path)
+  try:
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    # Write a temporary file and move it in place, so nobody reads a
+    # half written cache.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+      f.write(CACHE_MAGIC + key)
+      marshal.dump(tuple(map(dump_ast, code)), f)
+    os.rename(tmp, filename)
+  except (EnvironmentError, ValueError):
+    pass # ValueError is marshal not being able to write something.
+  return code
+
 
 class Scheme(object):
+  # Whether the root Scheme has loaded the standard library yet. See
+  # 'bootstrap'.
+  bootstrapped = False
+
   def __init__(self, parent=None, table=None):
     self.parent = parent
     self._table = table or dict()
 
   def __call__(self, code):
+    if self.parent is None and not self.bootstrapped:
+      bootstrap(self)
+
     if isinstance(code, str):
       code = parse(code)
 
@@ -616,14 +775,108 @@ def Object_(scm, args):
 def liststar(scm, args):
   return list(map(scm.eval, args))
 
+@scm.setfunc('cons')
+def cons(scm, args):
+  car, cdr = map(scm.eval, args)
+  return Pair(car, cdr)
+
+@scm.setfunc('car')
+def car(scm, args):
+  pair, = map(scm.eval, args)
+  return pair.car
+
+@scm.setfunc('cdr')
+def cdr(scm, args):
+  pair, = map(scm.eval, args)
+  return pair.cdr
+
+@scm.setfunc('pair?')
+def pairp(scm, args):
+  x, = map(scm.eval, args)
+  return isinstance(x, Pair)
+
+@scm.setfunc('null?')
+def nullp(scm, args):
+  x, = map(scm.eval, args)
+  return x is nil
+
+# The list functions below loop instead of recursing, so they work on
+# lists of any length.
+
+@scm.setfunc('length')
+def length(scm, args):
+  items, = map(scm.eval, args)
+  count = 0
+  for _ in items:
+    count += 1
+  return count
+
+@scm.setfunc('map')
+def map_(scm, args):
+  f = scm.eval(args[0])
+  lists = list(map(scm.eval, args[1:]))
+  # Builtins evaluate their arguments themselves, so they get the
+  # items quoted.
+  if isinstance(f, Lambda):
+    call = lambda items: f(None, List(items))
+  else:
+    call = lambda items: f(scm, List(List([Symbol('quote'), item])
+                                     for item in items))
+  return make_list([toast(call(items)) for items in zip(*lists)])
+
+@scm.setfunc('append')
+def append(scm, args):
+  lists = list(map(scm.eval, args))
+  if not lists:
+    return nil
+  items = []
+  for items_ in lists[:-1]:
+    items.extend(items_)
+  return make_list(items, lists[-1])
+
+@scm.setfunc('reverse')
+def reverse(scm, args):
+  items, = map(scm.eval, args)
+  result = nil
+  for item in items:
+    result = Pair(item, result)
+  return result
+
 @scm.setfunc('gcd')
 def gcd_(scm, args):
   a, b = map(scm.eval, args)
-  return fractions.gcd(a, b)
+  # math.gcd is Python 3.5+, and fractions.gcd is gone since 3.9.
+  return abs((getattr(math, 'gcd', None) or fractions.gcd)(a, b))
+
+class EvalCounter(object):
+  def __init__(self):
+    self.count = 0
 
-# Load the standard library.
-with open(PATH_TO_STDLIB) as f:
-  scm(f.read())
+def count_evals():
+  """Start counting the lists every Scheme evaluates.
+
+  Returns the counter, whose 'count' goes up from then on.
+  """
+  counter = EvalCounter()
+  eval_ = Scheme.eval
+
+  def counting_eval(self, ast):
+    if isinstance(ast, List):
+      counter.count += 1
+    return eval_(self, ast)
+
+  Scheme.eval = counting_eval
+  return counter
+
+def bootstrap(scm):
+  """Load the standard library into the root Scheme 'scm', once.
+
+  The root does this itself the first time it runs code, so importing
+  this module doesn't have to.
+  """
+  if not scm.bootstrapped:
+    scm.bootstrapped = True
+    scm(parse_path(PATH_TO_STDLIB))
 
 def main():
   # TODO: Real option parsing.
@@ -635,10 +888,11 @@ def main():
     print('Usage: python %s script.scm [--use-legacy-parser]' % sys.argv[0])
     return 1
 
-  with open(sys.argv[1]) as f:
-    content = f.read()
-
-  scm(parser(content))
+  if parser is parse:
+    scm(parse_path(sys.argv[1]))
+  else:
+    with open(sys.argv[1]) as f:
+      scm(parser(f.read()))
 
 
 if __name__ == '__main__':